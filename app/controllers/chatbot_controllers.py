@@ -1,17 +1,94 @@
 # app/controllers/chatbot_controllers.py
 
-from fastapi import Request, Depends
+from fastapi import BackgroundTasks, Request, Response, Depends
+from fastapi.responses import StreamingResponse
+from app.services.event_hub import EventHub
+from app.services.idempotency import IDEMPOTENCY_KEY_HEADER, MAX_KEY_LENGTH, REPLAYED_HEADER, fingerprint
 from app.services.chatbot_services import ChatbotService
 from app.services.user_services import UserService
 from app.models.chatbot_models import  MessageInfo
 from app.schemas import ApiResponse
-import uuid 
-async def get_chatbot_service(request: Request) -> ChatbotService:
-    return ChatbotService(request.app.mongodb)
+from app.serialization import TrustedJSONResponse, dumps
+from app.middlewares.user_middleware import Identity
+from app.dependencies import get_chatbot_service, get_user_service
+from app.tracing import traced
+from typing import Any, Awaitable, AsyncIterator, Callable, List, Optional, Tuple, Union
+from datetime import datetime
+import asyncio
+import hashlib
 
-async def get_user_service(request: Request) -> UserService:
-    return UserService(request.app.mongodb)
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+ETAG_HEADER = "ETag"
+BOT_RESPONSE_EVENT = "bot_response"
+SSE_HEARTBEAT_SECONDS = 15
+CHATBOT_USER_ID = "4b3c9f32-bfee-426f-ba09-4810da0930f1"
 
+def make_etag(*parts: Any) -> str:
+    # Weak, equal tags promise the same content rather than the same bytes
+    return 'W/"' + hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest() + '"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    return "*" in candidates or any(candidate.removeprefix("W/") == etag.removeprefix("W/") for candidate in candidates)
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={ETAG_HEADER: etag})
+
+@traced()
+async def authenticate(request: Request) -> Tuple[Identity, Optional[ApiResponse]]:
+    # The identity is resolved once per request, on the first call
+    identity: Identity = await request.state.identity
+    
+    if identity.error:
+        return identity, ApiResponse(type="error", message=identity.error)
+    
+    if not identity.is_authenticated:
+        return identity, ApiResponse(type="error", message="User not found")
+    
+    return identity, None
+
+@traced()
+async def authenticate_with(request: Request, *reads: Awaitable[Any]) -> Tuple[Identity, Optional[ApiResponse], List[Any]]:
+    # Reads that don't depend on the caller run alongside authentication,
+    # an authentication failure still takes precedence over their results
+    outcomes = await asyncio.gather(authenticate(request), *reads, return_exceptions=True)
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            raise outcome
+    (identity, error), *results = outcomes
+    return identity, error, results
+
+async def idempotent(
+    request: Request,
+    operation_name: str,
+    chat_id: str,
+    operation: Callable[[], Awaitable[ApiResponse]]
+) -> Union[ApiResponse, Response]:
+    # With an Idempotency-Key the first successful response is stored and retries replay it
+    key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+    if key is None:
+        return await operation()
+    
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return ApiResponse(type="error", message="Invalid Idempotency-Key")
+    
+    # Keys are only unique per caller and endpoint
+    scoped_key = f"{request.state.user_id}:{operation_name}:{chat_id}:{key}"
+    try:
+        result, replayed = await request.app.state.idempotency_store.execute(
+            scoped_key, fingerprint(await request.body()), operation
+        )
+    except Exception as e:
+        return ApiResponse(type="error", message=str(e))
+    
+    if isinstance(result, ApiResponse):
+        return result
+    return Response(result, media_type="application/json", headers={REPLAYED_HEADER: "true"} if replayed else None)
+
+@traced()
 async def create_chat(
     request: Request, 
     chatbot_service: ChatbotService = Depends(get_chatbot_service),
@@ -20,109 +97,236 @@ async def create_chat(
     try:
         # Create a chat with the chatbot ID
         user_id = request.state.user_id
-        chat = await chatbot_service.create_chat("4b3c9f32-bfee-426f-ba09-4810da0930f1",user_id)  # chatbot id
+        chat = await chatbot_service.create_chat(CHATBOT_USER_ID, user_id)
         
         if not chat:
             return ApiResponse(type="error", message="Failed to create chat")
 
         # Get the populated chat details
-        populated_chat = await chatbot_service.get_chat(chat.chat_id)
+        populated_chat = await chatbot_service.get_chat_document(chat.chat_id)
         
         # Return the response with the chat data inside a 'chats' list
         return ApiResponse(
             type="success", 
             data={
-                "chats": [populated_chat.model_dump()],
+                "chats": [populated_chat],
                 "chat_id":chat.chat_id
             }
         )
     except Exception as e:
         return ApiResponse(type="error", message=str(e))
     
+@traced()
 async def get_all_chat_messages(
     request: Request,
     chat_id: str,
+    context: Optional[str],
+    limit: int,
+    before: Optional[str],
+    after: Optional[str],
+    fields: Optional[List[str]],
     chatbot_service: ChatbotService = Depends(get_chatbot_service),
     user_service: UserService = Depends(get_user_service)
-) -> ApiResponse:
+) -> Union[ApiResponse, Response]:
     try:
-        body= await request.json()
+        body = await request.body()
 
-        user_id = request.state.user_id
+        async def read_history() -> Tuple[Optional[str], Optional[ApiResponse]]:
+            # The tag comes from the state read before the messages, so it is never newer than
+            # what it describes. Every write to the chat moves the state version, the flow
+            # definitions decide has_next and the request body picks the page.
+            chat_state = await chatbot_service.get_chat_state(chat_id)
+            if not chat_state:
+                return None, await chatbot_service.get_all_chat_messages(chat_id, context, limit, before, after, fields)
+            version = chat_state.get("version", 0)
+            if chat_state.get("pending"):
+                # A write is still landing, the messages read may not include it yet
+                return None, await chatbot_service.get_all_chat_messages(chat_id, context, limit, before, after, fields, chat_state)
+            etag = make_etag(
+                "history", chat_id, version, chat_state.get("seq", 0),
+                chatbot_service.flow_engine.flows.mtime_ns, body
+            )
+            if etag_matches(request, etag):
+                return etag, None
+            return etag, await chatbot_service.get_all_chat_messages(chat_id, context, limit, before, after, fields, chat_state)
+
+        _, error, ((etag, result),) = await authenticate_with(request, read_history())
         
-        if not user_id:
-            return ApiResponse(type="error", message="User not authenticated")
+        if error:
+            return error
         
-        user_result = await user_service.get_user(uuid.UUID(user_id))
+        if result is None:
+            return not_modified(etag)
         
-        if user_result.type == "error":
-            return user_result
+        if etag is None or result.type != "success":
+            return result
+        return TrustedJSONResponse(result, headers={ETAG_HEADER: etag})
+    except Exception as e:
+        return ApiResponse(type="error", message=str(e))
+
+
+@traced()
+async def export_chat_messages(
+    request: Request,
+    chat_id: str,
+    context: Optional[str],
+    start: Optional[datetime],
+    end: Optional[datetime],
+    export_format: str,
+    chatbot_service: ChatbotService = Depends(get_chatbot_service),
+    user_service: UserService = Depends(get_user_service)
+) -> Union[ApiResponse, StreamingResponse]:
+    try:
+        _, error, (exists,) = await authenticate_with(request, chatbot_service.chat_exists(chat_id))
         
-        if not user_result.data:
-            return ApiResponse(type="error", message="User not found")
+        if error:
+            return error
         
-        result = await chatbot_service.get_all_chat_messages(chat_id,context=body.get("context"))
+        if not exists:
+            return ApiResponse(type="error", message="Chat not found")
         
-        return result
+        extension = "json" if export_format == "json" else "ndjson"
+        return StreamingResponse(
+            chatbot_service.export_chat_messages(chat_id, context, start, end, export_format),
+            media_type="application/json" if extension == "json" else "application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="chat-{chat_id}.{extension}"'}
+        )
     except Exception as e:
         return ApiResponse(type="error", message=str(e))
 
-
+@traced()
 async def get_chatbot_response(
     request: Request,
     chat_id: str,
     context: str,
     chatbot_service: ChatbotService = Depends(get_chatbot_service),
     user_service: UserService = Depends(get_user_service)
+) -> Union[ApiResponse, Response]:
+    async def respond() -> ApiResponse:
+        try:
+            user_id = request.state.user_id
+            return await run_chatbot_turn(chat_id, context, user_id, chatbot_service, user_service)
+        except Exception as e:
+            return ApiResponse(type="error", message=str(e))
+    
+    return await idempotent(request, "get_response", chat_id, respond)
+
+@traced()
+async def run_chatbot_turn(
+    chat_id: str,
+    context: str,
+    user_id: str,
+    chatbot_service: ChatbotService,
+    user_service: UserService
 ) -> ApiResponse:
-    try:
-        user_id = request.state.user_id
-        chatbot_user_result = await user_service.get_chatbot_user()
-        
-        if chatbot_user_result.type == "error":
-            return chatbot_user_result
-        
-        if not chatbot_user_result.data:
-            return ApiResponse(type="error", message="Chatbot user not found")
-        
-        chatbot_user_id = str(chatbot_user_result.data["user_id"])
+    # The chat state read doesn't depend on the chatbot user, both go out together
+    chatbot_user_result, chat_state = await asyncio.gather(
+        user_service.get_chatbot_user(),
+        chatbot_service.get_chat_state(chat_id),
+        return_exceptions=True
+    )
+    
+    if chatbot_user_result.type == "error":
+        return chatbot_user_result
+    
+    if not chatbot_user_result.data:
+        return ApiResponse(type="error", message="Chatbot user not found")
     
-        result = await chatbot_service.get_chatbot_response(chat_id, context, chatbot_user_id,user_id)
+    if isinstance(chat_state, BaseException):
+        raise chat_state
+    
+    chatbot_user_id = str(chatbot_user_result.data["user_id"])
 
-        return result
+    return await chatbot_service.get_chatbot_response(chat_id, context, chatbot_user_id, user_id, chat_state)
+
+@traced()
+async def push_chatbot_response(
+    event_hub: EventHub,
+    chat_id: str,
+    context: str,
+    user_id: str,
+    chatbot_service: ChatbotService,
+    user_service: UserService
+):
+    try:
+        result = await run_chatbot_turn(chat_id, context, user_id, chatbot_service, user_service)
     except Exception as e:
-        return ApiResponse(type="error", message=str(e))
-    
-async def add_chat_message(
+        result = ApiResponse(type="error", message=str(e))
+    await event_hub.publish(chat_id, {"event": BOT_RESPONSE_EVENT, "data": result.model_dump()})
+
+async def stream_chat_events(
     request: Request,
     chat_id: str,
-    message: MessageInfo,
     chatbot_service: ChatbotService = Depends(get_chatbot_service),
     user_service: UserService = Depends(get_user_service)
-) -> ApiResponse:
+) -> Union[ApiResponse, StreamingResponse]:
     try:
-        body = await request.json()
-        context = body.get("context")
-        from_message_id = body.get("from_message_id")
-        user_id = request.state.user_id
+        _, error, (exists,) = await authenticate_with(request, chatbot_service.chat_exists(chat_id))
         
-        if not user_id:
-            return ApiResponse(type="error", message="User not authenticated")
+        if error:
+            return error
         
-        user_result = await user_service.get_user(uuid.UUID(user_id))
+        if not exists:
+            return ApiResponse(type="error", message="Chat not found")
         
-        if user_result.type == "error":
-            return user_result
-        
-        if not user_result.data:
-            return ApiResponse(type="error", message="User not found")
-        
-        result = await chatbot_service.add_chat_message(chat_id, message, str(user_id), context, from_message_id)
-        
-        return result
+        return StreamingResponse(
+            _event_stream(request.app.state.event_hub, chat_id),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
     except Exception as e:
         return ApiResponse(type="error", message=str(e))
 
+async def _event_stream(event_hub: EventHub, chat_id: str) -> AsyncIterator[str]:
+    async with event_hub.subscribe(chat_id) as queue:
+        yield ": connected\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: {event['event']}\ndata: {dumps(event['data']).decode()}\n\n"
+    
+@traced()
+async def add_chat_message(
+    request: Request,
+    chat_id: str,
+    message: MessageInfo,
+    push: bool,
+    background_tasks: BackgroundTasks,
+    chatbot_service: ChatbotService = Depends(get_chatbot_service),
+    user_service: UserService = Depends(get_user_service)
+) -> Union[ApiResponse, Response]:
+    async def add() -> ApiResponse:
+        try:
+            body = await request.json()
+            context = body.get("context")
+            from_message_id = body.get("from_message_id")
+            identity, error = await authenticate(request)
+            
+            if error:
+                return error
+            
+            user_id = identity.raw_user_id
+            
+            result = await chatbot_service.add_chat_message(chat_id, message, str(user_id), context, from_message_id)
+            
+            # The bot turn runs once the reply is sent and is delivered to the chat's subscribers
+            if push and result.type == "success":
+                background_tasks.add_task(
+                    push_chatbot_response, request.app.state.event_hub, chat_id, context, str(user_id), chatbot_service, user_service
+                )
+            
+            return result
+        except Exception as e:
+            return ApiResponse(type="error", message=str(e))
+    
+    # A replayed add doesn't schedule the pushed bot turn again
+    return await idempotent(request, "add_chat", chat_id, add)
+
+@traced()
 async def delete_chat_message(
     request: Request,
     chat_id: str,
@@ -132,18 +336,12 @@ async def delete_chat_message(
     user_service: UserService = Depends(get_user_service)
 ) -> ApiResponse:
     try:
-        user_id = request.state.user_id
+        identity, error = await authenticate(request)
         
-        if not user_id:
-            return ApiResponse(type="error", message="User not authenticated")
+        if error:
+            return error
         
-        user_result = await user_service.get_user(uuid.UUID(user_id))
-        
-        if user_result.type == "error":
-            return user_result
-        
-        if not user_result.data:
-            return ApiResponse(type="error", message="User not found")
+        user_id = identity.raw_user_id
         
         return await chatbot_service.delete_chat_message(chat_id, message_id, context, user_id)
         
@@ -151,6 +349,7 @@ async def delete_chat_message(
     except Exception as e:
         return ApiResponse(type="error", message=str(e))
     
+@traced()
 async def update_chat_message(
     request: Request,
     chat_id: str,
@@ -161,18 +360,12 @@ async def update_chat_message(
     user_service: UserService = Depends(get_user_service)
 ) -> ApiResponse:
     try:
-        user_id = request.state.user_id
-        
-        if not user_id:
-            return ApiResponse(type="error", message="User not authenticated")
-        
-        user_result = await user_service.get_user(uuid.UUID(user_id))
+        identity, error = await authenticate(request)
         
-        if user_result.type == "error":
-            return user_result
+        if error:
+            return error
         
-        if not user_result.data:
-            return ApiResponse(type="error", message="User not found")
+        user_id = identity.raw_user_id
         
         result = await chatbot_service.update_chat_message(chat_id, message_id, context, message, str(user_id))
         
@@ -181,26 +374,40 @@ async def update_chat_message(
         return ApiResponse(type="error", message=str(e))
     
 
+@traced()
 async def get_user_chats(
     request: Request,
+    response: Response,
+    limit: int,
+    before: Optional[str],
     chatbot_service: ChatbotService = Depends(get_chatbot_service),
     user_service: UserService = Depends(get_user_service)
-) -> ApiResponse:
+) -> Union[ApiResponse, Response]:
     try:
         user_id = request.state.user_id
+
+        async def read_chats() -> Tuple[str, Optional[Tuple[ApiResponse, Optional[str]]]]:
+            # Read before the page, so the tag is never newer than the list it describes
+            version = await chatbot_service.get_user_chats_marker(user_id)
+            etag = make_etag("chats", user_id, version, limit, before)
+            if etag_matches(request, etag):
+                return etag, None
+            return etag, await chatbot_service.get_user_chats(user_id, limit, before)
+
+        # The inbox is keyed by the raw User-ID header, so it can load while the caller is verified
+        _, error, ((etag, page),) = await authenticate_with(request, read_chats())
         
-        if not user_id:
-            return ApiResponse(type="error", message="User not authenticated")
-        
-        user_result = await user_service.get_user(uuid.UUID(user_id))
-        
-        if user_result.type == "error":
-            return user_result
+        if error:
+            return error
         
-        if not user_result.data:
-            return ApiResponse(type="error", message="User not found")
+        if page is None:
+            return not_modified(etag)
         
-        result = await chatbot_service.get_user_chats(user_id)
+        result, next_cursor = page
+        if next_cursor:
+            response.headers[NEXT_CURSOR_HEADER] = next_cursor
+        if result.type == "success":
+            response.headers[ETAG_HEADER] = etag
         
         return result
     except Exception as e:
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Commands whose plan explain can describe
+EXPLAINABLE_COMMANDS = frozenset({"find", "aggregate", "count", "distinct", "findAndModify", "delete", "update"})
+# Session and cluster bookkeeping the driver adds, explain rejects or ignores them
+_DRIVER_FIELDS = frozenset({"lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern"})
+EXPLAIN_INTERVAL_SECONDS = 60.0
+
+_record_lock = threading.Lock()
+
+
+class DbCallBudgetExceeded(AssertionError):
+    pass
+
+
+class DbCallStats:
+    # Counts the commands issued while it is current; nested stats also count towards their parent
+    __slots__ = ("scope", "calls", "parent")
+
+    def __init__(self, scope: Optional[Dict[str, Any]] = None, parent: Optional["DbCallStats"] = None):
+        self.scope = scope
+        self.calls = 0
+        self.parent = parent
+
+    @property
+    def route(self) -> str:
+        route = self.scope.get("route") if self.scope else None
+        if route is not None:
+            return route.path
+        return self.parent.route if self.parent else "-"
+
+    def record(self):
+        # Commands of one request can complete on several driver threads at once
+        with _record_lock:
+            stats = self
+            while stats is not None:
+                stats.calls += 1
+                stats = stats.parent
+
+
+_current: ContextVar[Optional[DbCallStats]] = ContextVar("db_call_stats", default=None)
+
+
+def current_stats() -> Optional[DbCallStats]:
+    return _current.get()
+
+
+@contextmanager
+def track_db_calls(scope: Optional[Dict[str, Any]] = None) -> Iterator[DbCallStats]:
+    stats = DbCallStats(scope, parent=_current.get())
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def db_call_budget(max_calls: int) -> Iterator[DbCallStats]:
+    # For tests: fails when the wrapped code issues more than max_calls database commands, e.g.
+    #   with db_call_budget(3):
+    #       await client.post(f"/api/v1/chatbot/{chat_id}/get_response", ...)
+    with track_db_calls() as stats:
+        yield stats
+    if stats.calls > max_calls:
+        raise DbCallBudgetExceeded(f"{stats.calls} database calls, budget is {max_calls}")
+
+
+def _plan_summary(plan: Dict[str, Any]) -> str:
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("indexName"):
+            stage = f"{stage}({plan['indexName']})"
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " <- ".join(stages)
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    def __init__(self, threshold_ms: Optional[float] = None):
+        self.threshold = (threshold_ms if threshold_ms is not None else float(os.getenv("SLOW_QUERY_MS", "100"))) / 1000
+        self.client = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._started: Dict[Tuple[Any, int], Tuple[Any, str, str]] = {}
+        self._explained: Dict[Tuple[str, str, str], float] = {}
+        self._lock = threading.Lock()
+
+    def attach(self, client: Any):
+        # Explains run on the app's loop through the same client
+        self.client = client
+        self._loop = asyncio.get_running_loop()
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        stats = _current.get()
+        if stats is not None:
+            stats.record()
+        if self.threshold > 0:
+            self._started[(event.connection_id, event.request_id)] = (event.command, event.database_name, stats.route if stats else "-")
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._finished(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._finished(event)
+
+    def _finished(self, event):
+        started = self._started.pop((event.connection_id, event.request_id), None)
+        if started is None or event.duration_micros < self.threshold * 1e6:
+            return
+
+        command, database_name, route = started
+        name = event.command_name
+        collection = command.get(name) if isinstance(command.get(name), str) else ""
+        logger.warning(
+            "Slow MongoDB %s on %s took %.1fms route=%s filter=%s sort=%s",
+            name, collection, event.duration_micros / 1000, route,
+            command.get("filter", command.get("query", command.get("pipeline"))), command.get("sort")
+        )
+        if name in EXPLAINABLE_COMMANDS and self._should_explain(collection, name, command):
+            explained = {key: value for key, value in command.items() if key not in _DRIVER_FIELDS and not key.startswith("$")}
+            asyncio.run_coroutine_threadsafe(self._explain(database_name, collection, name, explained), self._loop)
+
+    def _should_explain(self, collection: str, name: str, command: Any) -> bool:
+        if self.client is None or self._loop is None or self._loop.is_closed():
+            return False
+        # One explain per query shape and interval, so a slow hot path can't double the load
+        shape = (collection, name, str(sorted((command.get("filter") or {}).keys())))
+        now = time.monotonic()
+        with self._lock:
+            if now - self._explained.get(shape, float("-inf")) < EXPLAIN_INTERVAL_SECONDS:
+                return False
+            self._explained[shape] = now
+        return True
+
+    async def _explain(self, database_name: str, collection: str, name: str, command: Dict[str, Any]):
+        # The task inherited the request's context, its own command isn't the request's
+        _current.set(None)
+        try:
+            result = await self.client[database_name].command({"explain": command, "verbosity": "queryPlanner"})
+            plan = result.get("queryPlanner", {}).get("winningPlan", {})
+            logger.warning("Winning plan for slow %s on %s: %s", name, collection, _plan_summary(plan))
+        except Exception as e:
+            logger.warning("Could not explain slow %s on %s: %s", name, collection, e)
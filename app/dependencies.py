@@ -0,0 +1,11 @@
+from fastapi import Request
+from app.services.chatbot_services import ChatbotService
+from app.services.user_services import UserService
+
+# Services are created once in lifespan and shared by every request
+
+async def get_chatbot_service(request: Request) -> ChatbotService:
+    return request.app.state.chatbot_service
+
+async def get_user_service(request: Request) -> UserService:
+    return request.app.state.user_service
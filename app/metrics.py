@@ -0,0 +1,302 @@
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from pymongo import monitoring
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.db_monitor import track_db_calls
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ERROR_BODY_PREFIX = b'{"type":"error"'
+# Open streams last as long as the client stays connected
+LONG_LIVED_SUFFIXES = ("/events",)
+
+Labels = Tuple[str, ...]
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # Per label set: a count per bucket (the last one is +Inf), the sum and the total count
+        self._series: Dict[Labels, List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def sum(self, *labels: str) -> float:
+        series = self._series.get(labels)
+        return series[1] if series else 0.0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {repr(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Gauge:
+    # Reads its value when scraped
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", f"{self.name} {_format_value(self.read())}"]
+
+
+class ObservedCounter(Gauge):
+    # A count kept by another component, read when scraped
+    kind = "counter"
+
+
+class DecayingAverage:
+    # Moving average of recent samples that also fades towards zero while no samples arrive
+    def __init__(self, alpha: float = 0.2, half_life: float = 5.0):
+        self.alpha = alpha
+        self.half_life = half_life
+        self._value = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def observe(self, sample: float):
+        with self._lock:
+            self._value = self._decayed(time.monotonic()) * (1 - self.alpha) + sample * self.alpha
+            self._updated = time.monotonic()
+
+    def value(self) -> float:
+        return self._decayed(time.monotonic())
+
+    def _decayed(self, now: float) -> float:
+        return self._value * 0.5 ** ((now - self._updated) / self.half_life)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    "http_requests_total", "HTTP requests by route and status code.", ("method", "route", "status")
+))
+HTTP_ERRORS = REGISTRY.register(Counter(
+    "http_request_errors_total", "Requests answered with an error body or a 5xx status.", ("method", "route")
+))
+HTTP_LATENCY = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "Time from receiving a request to sending its last byte, event streams excluded.", ("method", "route")
+))
+HTTP_DB_CALLS = REGISTRY.register(Histogram(
+    "http_request_db_calls", "MongoDB commands issued per request before its last byte was sent.", ("method", "route"), (1, 2, 3, 5, 8, 13, 21, 34)
+))
+CHAT_WRITE_CONFLICTS = REGISTRY.register(Counter(
+    "chat_write_conflicts_total", "Chat writes that lost a version check, by whether they were retried or rejected.", ("outcome",)
+))
+MONGO_COMMAND_LATENCY = REGISTRY.register(Histogram(
+    "mongo_command_duration_seconds", "MongoDB command round trips by collection and command.", ("collection", "command")
+))
+MONGO_COMMAND_FAILURES = REGISTRY.register(Counter(
+    "mongo_command_failures_total", "MongoDB commands that failed.", ("collection", "command")
+))
+MONGO_CHECKOUT_WAIT = REGISTRY.register(Histogram(
+    "mongo_pool_checkout_wait_seconds", "Time spent waiting to check a connection out of the pool."
+))
+MONGO_CHECKOUT_FAILURES = REGISTRY.register(Counter(
+    "mongo_pool_checkout_failures_total", "Connection checkouts that failed.", ("reason",)
+))
+MONGO_CONNECTIONS = REGISTRY.register(Counter(
+    "mongo_pool_connection_events_total", "Pool connections created and closed.", ("event",)
+))
+# Admission control sheds load on this rather than on the histogram, which never forgets
+RECENT_CHECKOUT_WAIT = DecayingAverage()
+ADMISSION_REJECTIONS = REGISTRY.register(Counter(
+    "admission_rejections_total", "Requests turned away by rate limiting or load shedding.", ("reason",)
+))
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        # The collection is only part of the started event
+        self._collections: Dict[int, str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        self._collections[event.request_id] = target if isinstance(target, str) else ""
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        collection = self._collections.pop(event.request_id, "")
+        MONGO_COMMAND_LATENCY.observe(event.duration_micros / 1e6, collection, event.command_name)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        collection = self._collections.pop(event.request_id, "")
+        MONGO_COMMAND_LATENCY.observe(event.duration_micros / 1e6, collection, event.command_name)
+        MONGO_COMMAND_FAILURES.inc(collection, event.command_name)
+
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    def connection_checked_out(self, event: monitoring.ConnectionCheckedOutEvent):
+        MONGO_CHECKOUT_WAIT.observe(event.duration)
+        RECENT_CHECKOUT_WAIT.observe(event.duration)
+
+    def connection_check_out_failed(self, event: monitoring.ConnectionCheckOutFailedEvent):
+        MONGO_CHECKOUT_WAIT.observe(event.duration)
+        RECENT_CHECKOUT_WAIT.observe(event.duration)
+        MONGO_CHECKOUT_FAILURES.inc(str(event.reason))
+
+    def connection_created(self, event):
+        MONGO_CONNECTIONS.inc("created")
+
+    def connection_closed(self, event):
+        MONGO_CONNECTIONS.inc("closed")
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+        error_body = False
+        first_body = True
+        recorded = False
+        db_calls = None
+
+        def record():
+            nonlocal recorded
+            if recorded:
+                return
+            recorded = True
+            # The matched route template keeps the label set bounded
+            route = scope.get("route")
+            route_label = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            HTTP_REQUESTS.inc(method, route_label, str(status))
+            if error_body or status >= 500:
+                HTTP_ERRORS.inc(method, route_label)
+            # A stream's duration is how long its client stayed, not how fast it was answered
+            if not scope["path"].endswith(LONG_LIVED_SUFFIXES):
+                HTTP_LATENCY.observe(time.perf_counter() - started, method, route_label)
+                HTTP_DB_CALLS.observe(db_calls.calls if db_calls is not None else 0, method, route_label)
+
+        async def send_wrapper(message: Message):
+            nonlocal status, error_body, first_body
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                if first_body:
+                    first_body = False
+                    # Failures are mostly ApiResponse(type="error") bodies sent with a 200
+                    error_body = message.get("body", b"").startswith(ERROR_BODY_PREFIX)
+                if not message.get("more_body", False):
+                    # Background tasks run after the last byte and are not the client's latency
+                    record()
+            await send(message)
+
+        try:
+            with track_db_calls(scope) as db_calls:
+                await self.app(scope, receive, send_wrapper)
+        finally:
+            record()
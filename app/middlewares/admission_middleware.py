@@ -0,0 +1,118 @@
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from app.metrics import ADMISSION_REJECTIONS, LONG_LIVED_SUFFIXES, RECENT_CHECKOUT_WAIT, REGISTRY, Gauge
+from app.middlewares.user_middleware import ANONYMOUS_PATHS, DEFAULT_USER_ID, USER_ID_HEADER
+
+
+class TokenBucketTable:
+    # One bucket per caller, refilled lazily when the caller shows up again. The least recently
+    # seen buckets are evicted past max_size; a bucket idle long enough to be evicted is full
+    # anyway, so eviction only forgets callers that were behaving.
+    def __init__(self, rate: float, burst: float, max_size: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self._buckets: "OrderedDict[bytes, list]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def take(self, key: bytes, now: float) -> Tuple[bool, float]:
+        # Returns whether the request may proceed, and otherwise how long until a token is available
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True, 0.0
+        return False, (1 - bucket[0]) / self.rate
+
+
+class AdmissionMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        rate = float(os.getenv("RATE_LIMIT_PER_SECOND", "20"))
+        self.buckets: Optional[TokenBucketTable] = TokenBucketTable(
+            rate,
+            float(os.getenv("RATE_LIMIT_BURST", "40")),
+            int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))
+        ) if rate > 0 else None
+        self.max_in_flight = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "512"))
+        self.max_pool_wait = float(os.getenv("ADMISSION_MAX_POOL_WAIT_MS", "250")) / 1000
+        self.in_flight = 0
+        REGISTRY.register(Gauge("http_requests_in_flight", "Requests being handled, open event streams excluded.", lambda: self.in_flight))
+        REGISTRY.register(Gauge("rate_limit_buckets", "Callers with a rate limit bucket in memory.", lambda: len(self.buckets or ())))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or scope["path"] in ANONYMOUS_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        # Overload is checked first: a request shed for capacity shouldn't also spend its caller's tokens
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            await self.reject(send, 503, "in_flight", "Server is busy, retry shortly", 1.0)
+            return
+        if self.max_pool_wait and RECENT_CHECKOUT_WAIT.value() > self.max_pool_wait:
+            await self.reject(send, 503, "pool_wait", "Server is busy, retry shortly", 1.0)
+            return
+
+        if self.buckets is not None:
+            user_id = DEFAULT_USER_ID.encode()
+            for name, value in scope["headers"]:
+                if name == USER_ID_HEADER:
+                    user_id = value
+                    break
+            allowed, retry_after = self.buckets.take(user_id, time.monotonic())
+            if not allowed:
+                await self.reject(send, 429, "rate_limited", "Too many requests", retry_after)
+                return
+
+        if scope["path"].endswith(LONG_LIVED_SUFFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        self.in_flight += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.in_flight -= 1
+
+        async def send_wrapper(message: Message):
+            await send(message)
+            # Background tasks after the last byte don't hold a slot
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                release()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            release()
+
+    async def reject(self, send: Send, status: int, reason: str, message: str, retry_after: float):
+        ADMISSION_REJECTIONS.inc(reason)
+        body = b'{"type":"error","message":"' + message.encode() + b'","data":null}'
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
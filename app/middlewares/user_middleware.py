@@ -1,25 +1,89 @@
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
-from starlette.responses import Response
+from starlette.types import ASGIApp, Receive, Scope, Send
+import asyncio
+from typing import Any, Dict, Optional
 import uuid
 
-class UserMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
+from app.tracing import traced
+
+DEFAULT_USER_ID = "f20e9aad-1e32-4e37-8944-969dadb5aa6f"
+USER_ID_HEADER = b"user-id"
+# Probes and the root ping never need a caller identity
+ANONYMOUS_PATHS = frozenset({"/", "/healthz", "/readyz", "/metrics"})
+
+
+class Identity:
+    __slots__ = ("raw_user_id", "user_id", "user", "error")
+
+    def __init__(self, raw_user_id: str, user_id: Optional[uuid.UUID] = None, user: Optional[Dict[str, Any]] = None, error: Optional[str] = None):
+        self.raw_user_id = raw_user_id
+        self.user_id = user_id
+        self.user = user
+        self.error = error
+
+    @property
+    def is_authenticated(self) -> bool:
+        return self.user is not None
+
+
+@traced()
+async def resolve_identity(app: Any, raw_user_id: str) -> Identity:
+    if not raw_user_id:
+        return Identity(raw_user_id, error="User not authenticated")
+
+    try:
+        user_id = uuid.UUID(raw_user_id)
+    except ValueError:
+        return Identity(raw_user_id, error="Invalid User-ID")
+
+    # Goes through the shared user cache, so repeat callers cost no round trip
+    result = await app.state.user_service.get_user(user_id)
+    if result.type == "error":
+        return Identity(raw_user_id, user_id, error=result.message)
+    return Identity(raw_user_id, user_id, user=result.data)
+
+
+class IdentityLookup:
+    # Awaiting it resolves the identity once, on first use, so routes that never authenticate cost no lookup
+    __slots__ = ("app", "raw_user_id", "_task")
+
+    def __init__(self, app: Any, raw_user_id: str):
+        self.app = app
+        self.raw_user_id = raw_user_id
+        self._task: Optional[asyncio.Future] = None
+
+    def __await__(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(resolve_identity(self.app, self.raw_user_id))
+        return self._task.__await__()
+
+    def cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+
+class UserMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or scope["path"] in ANONYMOUS_PATHS:
+            await self.app(scope, receive, send)
+            return
+
         # Retrieve the User-ID from headers
-        user_id_str = request.headers.get("User-ID",  "f20e9aad-1e32-4e37-8944-969dadb5aa6f")
-        
-        # # Validate and parse the User-ID as a UUID, or generate a new one if invalid
-        # try:
-        #     user_id = uuid.UUID(user_id_str) if user_id_str else uuid.uuid4()
-        # except ValueError:
-        #     user_id = uuid.uuid4()
-        
-        print(user_id_str, "User Id")
-        
-        # Attach the User-ID to the request state
-        request.state.user_id = user_id_str
-        
-        # Process the request and get the response
-        response = await call_next(request)
-        
-        return response
+        raw_user_id = DEFAULT_USER_ID
+        for name, value in scope["headers"]:
+            if name == USER_ID_HEADER:
+                raw_user_id = value.decode("latin-1")
+                break
+
+        # Handlers that authenticate start the lookup and can overlap it with their own reads
+        identity = IdentityLookup(scope["app"], raw_user_id)
+        state = scope.setdefault("state", {})
+        state["user_id"] = raw_user_id
+        state["identity"] = identity
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            identity.cancel()
@@ -1,12 +1,16 @@
-from fastapi import APIRouter, Depends, Request
-from app.controllers.chatbot_controllers import create_chat, get_chatbot_response, get_all_chat_messages,get_chatbot_service, get_user_service, add_chat_message, delete_chat_message,update_chat_message,get_user_chats
+from fastapi import APIRouter, BackgroundTasks, Depends, Query, Request, Response
+from app.controllers.chatbot_controllers import create_chat, export_chat_messages, get_chatbot_response, get_all_chat_messages, add_chat_message, delete_chat_message,update_chat_message,get_user_chats, stream_chat_events
+from app.dependencies import get_chatbot_service, get_user_service
 from app.services.chatbot_services import ChatbotService
 from app.services.user_services import UserService
 from app.schemas import ApiResponse
+from app.serialization import TrustedJSONResponse
 from app.models.chatbot_models import  ChatI, MessageInfo
-from typing import List,Dict, Any,Optional
+from typing import List,Dict, Any,Optional, Literal
+from datetime import datetime
 
-from pydantic import BaseModel
+from app.services.pagination import DEFAULT_PAGE_SIZE, DEFAULT_CHATS_PAGE_SIZE, MAX_PAGE_SIZE
+from pydantic import BaseModel, Field
 
 router = APIRouter()
 
@@ -20,18 +24,26 @@ class AddChatMessageRequest(BaseModel):
     message: MessageInfo
     context: str
     from_message_id: Optional[str] = None
+    push: bool = False
 
 class DeleteChatMessageRequest(BaseModel):
     message_id: str
     context: str
 
+class ChatMessagesRequest(BaseModel):
+    context: Optional[str] = None
+    limit: int = Field(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+    before: Optional[str] = None
+    after: Optional[str] = None
+    fields: Optional[List[str]] = None
+
 @router.post("/create_chat", response_model=ApiResponse[Dict[str, Any]])
 async def create_new_chat(
     request: Request,
     chatbot_service: ChatbotService = Depends(get_chatbot_service),
     user_service: UserService = Depends(get_user_service)
 ):
-    return await create_chat(request, chatbot_service, user_service)
+    return TrustedJSONResponse(await create_chat(request, chatbot_service, user_service))
 
 @router.post("/{chat_id}/get_response", response_model=ApiResponse[Dict[str, Any]])
 async def get_response(
@@ -51,10 +63,21 @@ async def add_chat_message_route(
     request: Request,
     chat_id: str,
     message_request: AddChatMessageRequest,
+    background_tasks: BackgroundTasks,
+    chatbot_service: ChatbotService = Depends(get_chatbot_service),
+    user_service: UserService = Depends(get_user_service)
+):
+    return await add_chat_message(request, chat_id, message_request.message, message_request.push, background_tasks, chatbot_service, user_service)
+
+
+@router.get("/{chat_id}/events", response_model=None)
+async def stream_chat_events_route(
+    request: Request,
+    chat_id: str,
     chatbot_service: ChatbotService = Depends(get_chatbot_service),
     user_service: UserService = Depends(get_user_service)
 ):
-    return await add_chat_message(request, chat_id, message_request.message, chatbot_service, user_service)
+    return await stream_chat_events(request, chat_id, chatbot_service, user_service)
 
 
 @router.delete("/{chat_id}/delete_chat_message", response_model=ApiResponse)
@@ -71,11 +94,38 @@ async def delete_chat_message_route(
 async def get_all_chat_messages_route(
     request: Request,
     chat_id: str,
+    messages_request: ChatMessagesRequest,
     chatbot_service: ChatbotService = Depends(get_chatbot_service),
     user_service: UserService = Depends(get_user_service)
 ):
-    return await get_all_chat_messages(request, chat_id, chatbot_service, user_service)
-
+    result = await get_all_chat_messages(
+        request,
+        chat_id,
+        messages_request.context,
+        messages_request.limit,
+        messages_request.before,
+        messages_request.after,
+        messages_request.fields,
+        chatbot_service,
+        user_service
+    )
+    # Conditional hits and tagged pages come back as finished responses
+    return result if isinstance(result, Response) else TrustedJSONResponse(result)
+
+
+
+@router.get("/{chat_id}/export", response_model=None)
+async def export_chat_messages_route(
+    request: Request,
+    chat_id: str,
+    context: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    format: Literal["ndjson", "json"] = "ndjson",
+    chatbot_service: ChatbotService = Depends(get_chatbot_service),
+    user_service: UserService = Depends(get_user_service)
+):
+    return await export_chat_messages(request, chat_id, context, start, end, format, chatbot_service, user_service)
 
 
 @router.put("/{chat_id}/update_chat_message", response_model=ApiResponse)
@@ -86,12 +136,15 @@ async def update_chat_message_route(
     chatbot_service: ChatbotService = Depends(get_chatbot_service),
     user_service: UserService = Depends(get_user_service)
 ):
-    return await update_chat_message(request, chat_id, update_request.message_id, update_request.context, update_request.message, chatbot_service, user_service)
+    return TrustedJSONResponse(await update_chat_message(request, chat_id, update_request.message_id, update_request.context, update_request.message, chatbot_service, user_service))
 
 
 @router.get("/", response_model=ApiResponse[List[Dict[str, Any]]])
 async def get_user_chats_route(
     request: Request,
+    response: Response,
+    limit: int = Query(default=DEFAULT_CHATS_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[str] = None,
     chatbot_service: ChatbotService = Depends(get_chatbot_service),
     user_service: UserService = Depends(get_user_service)
 ):
@@ -99,4 +152,4 @@ async def get_user_chats_route(
     if not user_id:
         return ApiResponse(type="error", message="User not authenticated")
     
-    return await get_user_chats(request,chatbot_service,user_service)
+    return await get_user_chats(request, response, limit, before, chatbot_service, user_service)
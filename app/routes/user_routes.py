@@ -1,5 +1,6 @@
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends
 from app.services.user_services import UserService
+from app.dependencies import get_user_service
 from app.models.user_models import UserCreate
 from app.schemas import ApiResponse
 from uuid import UUID
@@ -7,9 +8,6 @@ from typing import Dict, Any, List
 
 router = APIRouter()
 
-async def get_user_service(request: Request) -> UserService:
-    return UserService(request.app.mongodb)
-
 @router.post("/", response_model=ApiResponse[Dict[str, Any]])
 async def create_new_user(user: UserCreate, user_service: UserService = Depends(get_user_service)):
     return await user_service.create_user(user)
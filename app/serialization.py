@@ -0,0 +1,50 @@
+from typing import Any, Dict
+
+import orjson
+from bson import ObjectId
+from fastapi.responses import ORJSONResponse
+
+from app.schemas import ApiResponse
+
+
+def chat_document(document: Dict[str, Any]) -> Dict[str, Any]:
+    # Documents in chatbot_messages are written by ChatbotService from validated ChatI
+    # models, so reads reshape them into the ChatI layout without validating again
+    message = document["message"]
+    return {
+        "from_user": document["from_user"],
+        "user_id": document["user_id"],
+        "chat_id": document["chat_id"],
+        "context": document.get("context", "ONBOARDING"),
+        "created_at": document["created_at"],
+        "updated_at": document["updated_at"],
+        "message": {
+            "type": message["type"],
+            "value": message["value"],
+            "action_id": message.get("action_id"),
+            "id": message["id"],
+        },
+        "actions": [
+            {"type": action["type"], "value": action["value"], "action_id": action["action_id"]}
+            for action in document.get("actions", ())
+        ],
+    }
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    # OPT_UTC_Z matches pydantic's rendering of UTC datetimes
+    return orjson.dumps(content, default=_default, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+
+
+class TrustedJSONResponse(ORJSONResponse):
+    # Returning this from a route skips FastAPI's response_model validation
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, ApiResponse):
+            content = {"type": content.type, "message": content.message, "data": content.data}
+        return dumps(content)
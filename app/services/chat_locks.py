@@ -0,0 +1,38 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+
+
+class ChatLockTable:
+    # One lock per chat with a write in flight; entries go away with their last holder, so the
+    # table only grows with the number of chats being written to at the same time
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max_size or int(os.getenv("CHAT_LOCK_TABLE_SIZE", "10000"))
+        self._locks: Dict[str, List] = {}
+        self.overflows = 0
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, chat_id: str) -> AsyncIterator[bool]:
+        # Yields whether another holder had to finish first
+        entry = self._locks.get(chat_id)
+        if entry is None:
+            if len(self._locks) >= self.max_size:
+                # Past the bound the chat's versioned writes alone keep it consistent
+                self.overflows += 1
+                yield False
+                return
+            entry = self._locks[chat_id] = [asyncio.Lock(), 0]
+
+        entry[1] += 1
+        try:
+            waited = entry[0].locked()
+            async with entry[0]:
+                yield waited
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[chat_id]
@@ -1,124 +1,418 @@
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
 from app.models.chatbot_models import ChatI, MessageInfo, ChatActionI
 from app.models.user_models import UserInDB
 from bson import ObjectId
 from uuid import UUID, uuid4
-import json
+import asyncio
+import logging
+import os
 
-from typing import List, Dict, Any, Tuple,Optional
+from typing import List, Dict, Any, Tuple,Optional, AsyncIterator, Awaitable, Callable
 from app.schemas import ApiResponse
+from app.serialization import chat_document, dumps
+from app.services.flow_engine import FlowEngine, CompiledContext, Transition
+from app.services.chat_locks import ChatLockTable
+from app.services.compactor import DeadRanges, add_dead_range, is_dead, live_filter
+from app.services.pagination import DEFAULT_PAGE_SIZE, DEFAULT_CHATS_PAGE_SIZE, MAX_PAGE_SIZE, build_projection, encode_cursor, encode_seq_cursor, keyset_filter, seq_filter
+from app.metrics import CHAT_WRITE_CONFLICTS
+from app.tracing import traced
 from datetime import datetime, timezone
 
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = 500
+
+class ChatStateConflict(Exception):
+    # The chat state document changed between reading it and writing the outcome
+    pass
+
+
+def version_filter(version: int) -> Dict[str, Any]:
+    # State documents written before versioning have no version field
+    return {"version": version} if version else {"version": {"$in": [0, None]}}
+
+
 class ChatbotService:
-    def __init__(self, db: AsyncIOMotorDatabase):
+    def __init__(self, db: AsyncIOMotorDatabase, flow_engine: FlowEngine, chat_locks: Optional[ChatLockTable] = None):
         self.db = db
         self.chatbot_messages = self.db['chatbot_messages']
         self.chatbot_messages_history = self.db['chatbot_messages_history']
+        self.chat_summaries = self.db['chat_summaries']
+        self.chat_inboxes = self.db['chat_inboxes']
         self.users = self.db['users']
         self.allowed_contexts=["ONBOARDING"]
-        self.chatbot_data = self.load_chatbot_data()
-        
-    
-    def load_chatbot_data(self) -> Dict[str, Any]:
-        with open('chatbot.json', 'r') as f:
-            return json.load(f)
+        self.flow_engine = flow_engine
+        self.chat_locks = chat_locks if chat_locks is not None else ChatLockTable()
+        self.write_retries = int(os.getenv("CHAT_WRITE_RETRIES", "3"))
 
-    def get_step_data(self, context: str, step: str) -> Dict[str, Any]:
-        return self.chatbot_data.get(context, {}).get(step, {})
+    def get_flow(self, context: str) -> Optional[CompiledContext]:
+        return self.flow_engine.get_context(context)
 
-    async def get_chatbot_response(self, chat_id: str, context: str, chatbot_user_id: str, user_id: str) -> ApiResponse:
-        last_message = await self.chatbot_messages.find_one(
-            {"chat_id": chat_id},
-            sort=[("updated_at", -1)]
+    def get_step_data(self, context: str, step: str) -> Dict[str, Any]:
+        flow = self.get_flow(context)
+        return flow.get_step_data(step) if flow else {}
+
+    def get_step_actions(self, context: str, step: str) -> List[ChatActionI]:
+        flow = self.get_flow(context)
+        return list(flow.get_actions(step)) if flow else []
+
+    def has_next_step(self, context: str, step: Optional[str]) -> bool:
+        flow = self.get_flow(context)
+        return flow.has_next(step) if flow else bool(not step)
+
+    def is_terminal_step(self, context: str, step: Optional[str]) -> bool:
+        flow = self.get_flow(context)
+        return flow.is_terminal(step) if flow else False
+
+    @traced()
+    async def get_chat_state(self, chat_id: str) -> Optional[Dict[str, Any]]:
+        return await self.chatbot_messages_history.find_one({"chat_id": chat_id})
+
+    @traced()
+    async def get_chat_with_message(self, chat_id: str, message_id: Optional[UUID]) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        # The chat state and the addressed message are independent reads
+        if message_id is None:
+            return await self.get_chat_state(chat_id), None
+        chat_state, message = await asyncio.gather(
+            self.get_chat_state(chat_id),
+            self.chatbot_messages.find_one({"chat_id": chat_id, "message.id": message_id})
+        )
+        return chat_state, message
+
+    @traced()
+    async def write_chat(
+        self,
+        chat_id: str,
+        attempt: Callable[[Optional[Dict[str, Any]]], Awaitable[ApiResponse]],
+        chat_state: Optional[Dict[str, Any]] = None
+    ) -> ApiResponse:
+        # Writes to one chat take turns within the process, and every attempt only commits if the
+        # chat state version it read is still current, which covers writers in other processes
+        async with self.chat_locks.hold(chat_id) as waited:
+            # State read before waiting for the previous writer is stale
+            if waited:
+                chat_state = None
+            for _ in range(self.write_retries + 1):
+                try:
+                    return await attempt(chat_state)
+                except ChatStateConflict:
+                    CHAT_WRITE_CONFLICTS.inc("retried")
+                    logger.info("Chat %s changed during a write, retrying", chat_id)
+                    chat_state = None
+        CHAT_WRITE_CONFLICTS.inc("rejected")
+        return ApiResponse(type="error", message="Chat was changed by another request, please retry")
+
+    @traced()
+    async def get_chatbot_response(
+        self,
+        chat_id: str,
+        context: str,
+        chatbot_user_id: str,
+        user_id: str,
+        chat_state: Optional[Dict[str, Any]] = None
+    ) -> ApiResponse:
+        # Two concurrent turns would both see the user's last message and both answer it
+        return await self.write_chat(
+            chat_id,
+            lambda state: self._get_chatbot_response(chat_id, context, chatbot_user_id, user_id, state),
+            chat_state
         )
-        
-        if not last_message:
-            return ApiResponse(type="error", message="Chat not found")
-
-        user = await self.users.find_one({"user_id": UUID(last_message['from_user'])})
 
-        if not user:
-            return ApiResponse(type="error", message="User not found")
+    async def _get_chatbot_response(
+        self,
+        chat_id: str,
+        context: str,
+        chatbot_user_id: str,
+        user_id: str,
+        chat_state: Optional[Dict[str, Any]] = None
+    ) -> ApiResponse:
+        # The chat state document answers "who spoke last and with which action" in one read
+        if chat_state is None:
+            chat_state = await self.get_chat_state(chat_id)
+
+        if not chat_state or "last_from_bot" not in chat_state:
+            chat_state, error = await self.rebuild_chat_state(chat_id, chat_state)
+            if error:
+                return error
+
+        current_step = chat_state.get(context)
+        version = chat_state.get("version", 0)
         
-        if user.get('is_bot') is True:
-            chat_history = await self.chatbot_messages_history.find_one({"chat_id": chat_id})
-            last_step = chat_history[context] if chat_history else None
-            context_data = self.chatbot_data.get(context, {})
-            has_next = last_step != list(context_data.keys())[-1] if last_step else True
+        if chat_state["last_from_bot"]:
+            has_next = self.has_next_step(context, current_step)
             return ApiResponse(type="success", data={"chats": [], "has_next": has_next})
         else:
-            action_id = last_message['message'].get('action_id')
+            action_id = chat_state.get("last_action_id")
             if action_id:
-                response = await self.responseByActionId[action_id](self, chat_id, context, chatbot_user_id, user_id)
-                
-                if action_id in ["action_step_1_1", "action_step_1_2"]:
-                    latest_messages = response
-                else:
-                    latest_messages = response
-                
-                chat_history = await self.chatbot_messages_history.find_one({"chat_id": chat_id})
-                current_step = chat_history[context] if chat_history else None
-                context_data = self.chatbot_data.get(context, {})
-                has_next = current_step != list(context_data.keys())[-1] if current_step else True
+                flow = self.get_flow(context)
+                transition = flow.get_transition(action_id) if flow else None
+                if not transition:
+                    return ApiResponse(type="error", message="Unknown action")
+
+                latest_messages = await self.execute_transition(chat_id, context, transition, chatbot_user_id, user_id, version)
+                has_next = self.has_next_step(context, transition.next_step)
                 
                 return ApiResponse(type="success", data={"chats": latest_messages, "has_next": has_next})
             else:
-                chat_history = await self.chatbot_messages_history.find_one({"chat_id": chat_id})
-                current_step = chat_history[context] if chat_history else None
                 if current_step:
-                    step_data = self.get_step_data(context, current_step)
-                    
-                    chat = ChatI(
-                        from_user=chatbot_user_id,
-                        chat_id=str(chat_id),
-                        user_id=str(user_id),
-                        message=MessageInfo(
-                            id=str(uuid4()),
-                            type="string",
-                            value=step_data.get("message", ""),
-                            action_id=None
-                        ),
-                        actions=[ChatActionI(**action) for action in step_data.get("actions", [])]
+                    chat = self.build_bot_message(
+                        str(chat_id),
+                        str(user_id),
+                        chatbot_user_id,
+                        self.get_step_data(context, current_step).get("message", ""),
+                        self.get_step_actions(context, current_step)
                     )
                     
                     # Insert the new chatbot message
-                    await self.chatbot_messages.insert_one(chat.model_dump(by_alias=True))
+                    chat_dict = self.to_document(chat)
+                    await self.insert_messages(chat_id, str(user_id), context, [chat_dict], expected_version=version)
                     
-                    context_data = self.chatbot_data.get(context, {})
-                    has_next = current_step != list(context_data.keys())[-1]
+                    has_next = self.has_next_step(context, current_step)
                     
                     return ApiResponse(type="success", data={"chats": [chat.model_dump()], "has_next": has_next})
                 else:
                     return ApiResponse(type="error", message="No current step found in chat history")                
+
+    @traced()
+    async def rebuild_chat_state(self, chat_id: str, chat_state: Optional[Dict[str, Any]]) -> Tuple[Optional[Dict[str, Any]], Optional[ApiResponse]]:
+        # Chats created before the state document tracked the last message
+        last_message = await self.chatbot_messages.find_one(
+            {"chat_id": chat_id, **live_filter((chat_state or {}).get("dead_ranges"))},
+            sort=[("seq", -1)]
+        )
+        
+        if not last_message:
+            return None, ApiResponse(type="error", message="Chat not found")
+
+        user = await self.users.find_one({"user_id": UUID(last_message['from_user'])})
+
+        if not user:
+            return None, ApiResponse(type="error", message="User not found")
+
+        last_state = self.last_message_state(MessageInfo(**last_message['message']), from_bot=user.get('is_bot') is True)
+        await self.update_chat_state(chat_id, last_state)
+        return {**(chat_state or {}), **last_state}, None
+
+    def last_message_state(self, message: MessageInfo, from_bot: bool) -> Dict[str, Any]:
+        return {
+            "last_message_id": message.id,
+            "last_from_bot": from_bot,
+            "last_action_id": message.action_id,
+        }
+
+    def last_message_state_from_doc(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        # Only the chat owner and the bot write to a chat
+        return self.last_message_state(MessageInfo(**message['message']), from_bot=message['from_user'] != message['user_id'])
+
+    @traced()
+    async def update_chat_state(self, chat_id: str, fields: Dict[str, Any]):
+        await self.chatbot_messages_history.update_one(
+            {"chat_id": chat_id},
+            {"$set": fields},
+            upsert=True
+        )
+
+    @traced()
+    async def commit_chat_state(self, chat_id: str, fields: Dict[str, Any], expected_version: int):
+        # The version check and the state change are a single update, so no other writer can see
+        # the new version next to the old state. The write counts as pending until it is released.
+        update: Dict[str, Any] = {"$inc": {"version": 1, "pending": 1}}
+        if fields:
+            update["$set"] = fields
+        result = await self.chatbot_messages_history.update_one(
+            {"chat_id": chat_id, **version_filter(expected_version)},
+            update
+        )
+        if not result.matched_count:
+            raise ChatStateConflict(chat_id)
+
+    @traced()
+    async def release_chat_write(self, chat_id: str):
+        # The version moves before a write's messages land; pending counts the writes still landing,
+        # and history is only tagged for caching while it is zero. Released on failure too.
+        await self.chatbot_messages_history.update_one({"chat_id": chat_id}, {"$inc": {"pending": -1}})
+
+    @traced()
+    async def update_chat_summary(
+        self,
+        chat_id: str,
+        user_id: str,
+        context: str,
+        step: Optional[str] = None,
+        last_message: Optional[Dict[str, Any]] = None,
+        count_delta: int = 0
+    ):
+        fields: Dict[str, Any] = {"updated_at": datetime.now(timezone.utc)}
+        if last_message:
+            fields["last_message"] = last_message
+        if step:
+            fields["context"] = context
+            fields["current_step"] = step
+        await self.chat_summaries.update_one(
+            {"chat_id": chat_id},
+            {
+                "$set": fields,
+                "$inc": {"message_count": count_delta},
+                "$setOnInsert": {"user_id": user_id}
+            },
+            upsert=True
+        )
+        # Moved once the summary landed, so a chat list read after the new version is never older than it
+        await self.chat_inboxes.update_one({"user_id": user_id}, {"$inc": {"version": 1}}, upsert=True)
+
+    @traced()
+    async def record_chat_write(
+        self,
+        chat_id: str,
+        user_id: str,
+        context: str,
+        step: Optional[str] = None,
+        last_message: Optional[Dict[str, Any]] = None,
+        count_delta: int = 0,
+        state: Optional[Dict[str, Any]] = None,
+        expected_version: Optional[int] = None,
+        alongside: Optional[Callable[[], Awaitable[Any]]] = None
+    ) -> Any:
+        # The chat state and the inbox summary change together on every write. With an expected
+        # version, alongside runs next to the summary once the state committed and its result is returned.
+        state_fields: Dict[str, Any] = dict(state or {})
+        if step:
+            state_fields[context] = step
+        if last_message:
+            state_fields.update(self.last_message_state_from_doc(last_message))
+
+        if expected_version is not None:
+            # The summary only follows once the versioned state write went through
+            await self.commit_chat_state(chat_id, state_fields, expected_version)
+            try:
+                writes = [self.update_chat_summary(chat_id, user_id, context, step, last_message, count_delta)]
+                if alongside is not None:
+                    writes.append(alongside())
+                results = await asyncio.gather(*writes)
+            finally:
+                await self.release_chat_write(chat_id)
+            return results[1] if alongside is not None else None
+
+        writes = [self.update_chat_summary(chat_id, user_id, context, step, last_message, count_delta)]
+        if state_fields:
+            writes.append(self.update_chat_state(chat_id, state_fields))
+        await asyncio.gather(*writes)
+        return None
+
+    @traced()
+    async def allocate_seq(
+        self,
+        chat_id: str,
+        count: int,
+        state_fields: Optional[Dict[str, Any]] = None,
+        expected_version: Optional[int] = None
+    ) -> int:
+        # The chat state document holds the chat's counter, $inc hands out a contiguous block atomically.
+        # With an expected version the block is only handed out if nobody wrote to the chat since it was read.
+        # The write counts as pending until it is released.
+        update: Dict[str, Any] = {"$inc": {"seq": count, "version": 1, "pending": 1}}
+        if state_fields:
+            update["$set"] = state_fields
+        query = {"chat_id": chat_id}
+        if expected_version is not None:
+            query.update(version_filter(expected_version))
+        chat_state = await self.chatbot_messages_history.find_one_and_update(
+            query,
+            update,
+            projection={"seq": 1},
+            upsert=expected_version is None,
+            return_document=ReturnDocument.AFTER
+        )
+        if chat_state is None:
+            raise ChatStateConflict(chat_id)
+        return chat_state["seq"] - count + 1
+
+    @traced()
+    async def insert_messages(
+        self,
+        chat_id: str,
+        user_id: str,
+        context: str,
+        documents: List[Dict[str, Any]],
+        step: Optional[str] = None,
+        removed: int = 0,
+        state: Optional[Dict[str, Any]] = None,
+        expected_version: Optional[int] = None
+    ):
+        # Numbering the documents also moves the chat state, the summary is written alongside the insert
+        state_fields: Dict[str, Any] = dict(state or {})
+        if step:
+            state_fields[context] = step
+        if documents:
+            state_fields.update(self.last_message_state_from_doc(documents[-1]))
+
+        first_seq = await self.allocate_seq(chat_id, len(documents), state_fields, expected_version)
+        for offset, document in enumerate(documents):
+            document["seq"] = first_seq + offset
+
+        try:
+            writes = [self.update_chat_summary(chat_id, user_id, context, step, documents[-1] if documents else None, len(documents) - removed)]
+            if documents:
+                writes.append(self.chatbot_messages.insert_many(documents, ordered=True))
+            await asyncio.gather(*writes)
+        finally:
+            await self.release_chat_write(chat_id)
+
+    def discard_from(self, chat_state: Dict[str, Any], start: int) -> Tuple[DeadRanges, int, Dict[str, Any]]:
+        # A rewind only records the dead range in the chat state, the compactor deletes the messages later
+        dead_ranges, removed = add_dead_range(chat_state.get("dead_ranges", []), start, chat_state.get("seq", 0))
+        state_fields = {"dead_ranges": dead_ranges, "compact_pending": True} if removed else {}
+        return dead_ranges, removed, state_fields
+
+    def to_document(self, chat: ChatI) -> Dict[str, Any]:
+        # _id is assigned up front so concurrent writes can reference the stored document
+        document = chat.model_dump(by_alias=True)
+        document["_id"] = ObjectId()
+        return document
             
-    async def get_user_chats(self, user_id: str) -> ApiResponse:
+    @traced()
+    async def get_user_chats_marker(self, user_id: str) -> int:
+        # Every summary write moves the user's inbox version, whatever the clocks of the writers say
+        inbox = await self.chat_inboxes.find_one({"user_id": user_id}, {"_id": 0, "version": 1})
+        return inbox["version"] if inbox else 0
+
+    @traced()
+    async def get_user_chats(self, user_id: str, limit: int = DEFAULT_CHATS_PAGE_SIZE, before: Optional[str] = None) -> Tuple[ApiResponse, Optional[str]]:
         try:
-            chats = await self.chatbot_messages.aggregate([
-                {"$match": {"user_id": user_id}},
-                {"$sort": {"updated_at": -1}},
-                {"$group": {
-                    "_id": "$chat_id",
-                    "last_message": {"$first": "$$ROOT"}
-                }},
-                {"$replaceRoot": {"newRoot": "$last_message"}},
-                {"$sort": {"updated_at": -1}}
-            ]).to_list(None)
-
-            # Convert ObjectId to string
-            for chat in chats:
+            limit = max(1, min(limit, MAX_PAGE_SIZE))
+            query: Dict[str, Any] = {"user_id": user_id}
+            if before:
+                try:
+                    query.update(keyset_filter(before, -1, "updated_at", "chat_id", str))
+                except ValueError as e:
+                    return ApiResponse(type="error", message=str(e)), None
+
+            summaries = await self.chat_summaries.find(query).sort(
+                [("updated_at", -1), ("chat_id", -1)]
+            ).limit(limit + 1).to_list(length=limit + 1)
+
+            next_cursor = None
+            if len(summaries) > limit:
+                summaries = summaries[:limit]
+                next_cursor = encode_cursor(summaries[-1]["updated_at"], summaries[-1]["chat_id"])
+
+            chats = []
+            for summary in summaries:
+                # Each entry stays shaped like the chat's last message
+                chat = dict(summary.get("last_message") or {"chat_id": summary["chat_id"], "user_id": summary["user_id"]})
                 if "_id" in chat and isinstance(chat["_id"], ObjectId):
                     chat["_id"] = str(chat["_id"])
-                if "chat_id" in chat and isinstance(chat["chat_id"], ObjectId):
-                    chat["chat_id"] = str(chat["chat_id"])
-
-            if not chats:
-                return ApiResponse(type="success", data=[])
+                chat["message_count"] = summary.get("message_count", 0)
+                chat["current_step"] = summary.get("current_step")
+                chats.append(chat)
 
-            return ApiResponse(type="success", data=chats)
+            return ApiResponse(type="success", data=chats), next_cursor
         except Exception as e:
-            return ApiResponse(type="error", message=str(e))
+            return ApiResponse(type="error", message=str(e)), None
 
         
+    @traced()
     async def create_chat(self, from_user_id:str,user_id: str) -> ChatI:
         step_data = self.get_step_data("ONBOARDING", "STEP_1")
         
@@ -129,7 +423,7 @@ class ChatbotService:
             action_id=None
         )
         
-        actions = [ChatActionI(**action) for action in step_data.get("actions", [])]
+        actions = self.get_step_actions("ONBOARDING", "STEP_1")
         
         chat = ChatI(
             from_user=str(from_user_id),
@@ -138,93 +432,114 @@ class ChatbotService:
             actions=actions
         )
         
-        chat_dict = chat.model_dump(by_alias=True)
+        chat_dict = self.to_document(chat)
         chat_dict['from_user'] = str(chat_dict['from_user'])  # Convert UUID to string for MongoDB
-        await self.chatbot_messages.insert_one(chat_dict)
-        
-        await self.update_chat_history(chat.chat_id, "ONBOARDING", "STEP_1")
+        await self.insert_messages(chat.chat_id, str(user_id), "ONBOARDING", [chat_dict], "STEP_1")
 
         return ChatI(**chat_dict)
 
+    @traced()
     async def get_all_chats(self) -> List[ChatI]:
         cursor = self.chatbot_messages.find()
         chats = []
         async for chat in cursor:
             chats.append(ChatI(**chat))
 
+    @traced()
     async def delete_chat_message(self, chat_id: str, message_id: str, context: str, user_id: str) -> ApiResponse:
+        return await self.write_chat(chat_id, lambda _: self._delete_chat_message(chat_id, message_id, context, user_id))
+
+    async def _delete_chat_message(self, chat_id: str, message_id: str, context: str, user_id: str) -> ApiResponse:
         try:
             if context not in self.allowed_contexts:
                 return ApiResponse(type="error", message="Invalid Context")
 
-            # 2. Check if chat has ended
-            chat_history = await self.chatbot_messages_history.find_one({"chat_id": chat_id})
+            try:
+                message_id_uuid, invalid_id = UUID(message_id), None
+            except ValueError as e:
+                message_id_uuid, invalid_id = None, e
+
+            # 2. Check if chat has ended, the message to be deleted is fetched alongside
+            chat_history, message_to_delete = await self.get_chat_with_message(chat_id, message_id_uuid)
             if not chat_history:
                 return ApiResponse(type="error", message="Chat not found")
 
             current_step = chat_history.get(context)
-            context_data = self.chatbot_data.get(context, {})
-            last_step = list(context_data.keys())[-1]
 
-            if current_step == last_step:
+            if self.is_terminal_step(context, current_step):
                 return ApiResponse(type="error", message="Cannot delete message after chat has ended")
 
             # 3. Get the message to be deleted
-            message_to_delete = await self.chatbot_messages.find_one({"chat_id": chat_id, "message.id": UUID(message_id)})
-            if not message_to_delete:
+            if invalid_id:
+                raise invalid_id
+            if not message_to_delete or is_dead(message_to_delete['seq'], chat_history.get("dead_ranges")):
                 return ApiResponse(type="error", message="Message not found")
 
             # 4. Check if the message is from the bot
             if message_to_delete['from_user'] != user_id:
                 return ApiResponse(type="error", message="Cannot delete bot message")
 
-            # 5. Delete the message and all subsequent messages
-            await self.chatbot_messages.delete_many({
-                "chat_id": chat_id,
-                "created_at": {"$gte": message_to_delete['created_at']}
-            })
+            # 5. Discard the message and all subsequent messages
+            dead_ranges, removed, discarded_state = self.discard_from(chat_history, message_to_delete['seq'])
 
-            # 6. Update the context step
-            previous_bot_message = await self.chatbot_messages.find_one({
-                "chat_id": chat_id,
-                "from_user": {"$ne": user_id},
-                "created_at": {"$lt": message_to_delete['created_at']}
-            }, sort=[("created_at", -1)])
+            # 6. Update the context step and the last message
+            remaining_message = await self.chatbot_messages.find_one(
+                {"chat_id": chat_id, "seq": {"$lt": message_to_delete['seq']}, **live_filter(dead_ranges)},
+                sort=[("seq", -1)]
+            )
 
-            if previous_bot_message:
-                previous_step = self.get_step_from_message(previous_bot_message, context)
-                await self.update_chat_history(chat_id, context, previous_step)
+            if remaining_message and remaining_message['from_user'] != user_id:
+                previous_bot_message = remaining_message
+            else:
+                previous_bot_message = await self.chatbot_messages.find_one({
+                    "chat_id": chat_id,
+                    "from_user": {"$ne": user_id},
+                    "seq": {"$lt": message_to_delete['seq']},
+                    **live_filter(dead_ranges)
+                }, sort=[("seq", -1)])
+
+            previous_step = self.get_step_from_message(previous_bot_message, context) if previous_bot_message else None
+            await self.record_chat_write(
+                chat_id, user_id, context, previous_step, remaining_message, -removed, discarded_state,
+                expected_version=chat_history.get("version", 0)
+            )
 
             return ApiResponse(type="success", message="Message successfully deleted",data=None)
 
+        except ChatStateConflict:
+            raise
         except Exception as e:
             return ApiResponse(type="error", message=str(e))
         
+    @traced()
     async def update_chat_message(self, chat_id: str, message_id: str, context: str, new_message: MessageInfo, user_id: str) -> ApiResponse:
+        return await self.write_chat(chat_id, lambda _: self._update_chat_message(chat_id, message_id, context, new_message, user_id))
+
+    async def _update_chat_message(self, chat_id: str, message_id: str, context: str, new_message: MessageInfo, user_id: str) -> ApiResponse:
         try:
             if context not in self.allowed_contexts:
                 return ApiResponse(type="error", message="Invalid Context")
 
-            # 2. Check if chat has ended
-            chat_history = await self.chatbot_messages_history.find_one({"chat_id": chat_id})
+            try:
+                message_id_uuid = UUID(message_id)
+            except ValueError:
+                message_id_uuid = None
+
+            # 2. Check if chat has ended, the message to be updated is fetched alongside
+            chat_history, message_to_update = await self.get_chat_with_message(chat_id, message_id_uuid)
             if not chat_history:
                 return ApiResponse(type="error", message="Chat not found")
 
             current_step = chat_history.get(context)
-            context_data = self.chatbot_data.get(context, {})
-            last_step = list(context_data.keys())[-1]
 
-            if current_step == last_step:
+            if self.is_terminal_step(context, current_step):
                 return ApiResponse(type="error", message="Cannot update message after chat has ended")
 
             # 3. Get the message to be updated
-            try:
-                message_id_uuid = UUID(message_id)
-            except ValueError:
+            if message_id_uuid is None:
                 return ApiResponse(type="error", message="Invalid message_id format")
 
-            message_to_update = await self.chatbot_messages.find_one({"chat_id": chat_id, "message.id": message_id_uuid})
-            if not message_to_update:
+            if not message_to_update or is_dead(message_to_update['seq'], chat_history.get("dead_ranges")):
                 return ApiResponse(type="error", message="Message not found")
 
             # 4. Check if the message is from the user
@@ -234,11 +549,8 @@ class ChatbotService:
             # 5. Handle action_id
             if new_message.action_id:
                 return ApiResponse(type="error", message="Cannot update message with an action_id")
-            delete_result = await self.chatbot_messages.delete_many({
-                "chat_id": chat_id,
-                "created_at": {"$gt": message_to_update['created_at']}
-            })
-            print(f"Deleted {delete_result.deleted_count} subsequent messages")
+            _, removed, discarded_state = self.discard_from(chat_history, message_to_update['seq'] + 1)
+            logger.debug("Discarded %s subsequent messages", removed)
             # 6. Create new_message_payload
             new_message_payload = {
                 "id": UUID(message_id),
@@ -246,121 +558,220 @@ class ChatbotService:
                 "type": new_message.type or "string"
             }
 
-            # 7. Update the message using find_one_and_update
+            # 7. Commit the chat state first, its version check decides whether this write goes ahead.
+            # The edited message stays the chat's last one, so the state is built from it up front.
+            # The message is then updated with find_one_and_update, alongside the summary
+            updated_at = datetime.now(timezone.utc)
+            new_step = self.get_step_from_user_message(new_message, context)
             try:
-                updated_message = await self.chatbot_messages.find_one_and_update(
-                    {"chat_id": chat_id, "message.id": message_id_uuid},
-                    {"$set": {
-                        "message": new_message_payload,
-                        "updated_at": datetime.now(timezone.utc)
-                    }},
-                    return_document=True  # This ensures we get the updated document
+                updated_message = await self.record_chat_write(
+                    chat_id, user_id, context, new_step,
+                    {**message_to_update, "message": new_message_payload, "updated_at": updated_at},
+                    -removed, discarded_state, expected_version=chat_history.get("version", 0),
+                    alongside=lambda: self.chatbot_messages.find_one_and_update(
+                        {"chat_id": chat_id, "message.id": message_id_uuid},
+                        {"$set": {
+                            "message": new_message_payload,
+                            "updated_at": updated_at
+                        }},
+                        return_document=True  # This ensures we get the updated document
+                    )
                 )
-                
+            except ChatStateConflict:
+                raise
             except Exception as e:
-                print(f"Error updating message: {str(e)}")
+                logger.error("Error updating message: %s", e)
                 return ApiResponse(type="error", message=f"Failed to update message: {str(e)}")
 
             if not updated_message:
                 return ApiResponse(type="error", message="Failed to update message")
 
-            # 8. Update the context step if necessary
-            new_step = self.get_step_from_user_message(new_message, context)
-            if new_step:
-                await self.update_chat_history(chat_id, context, new_step)
-
-            
-            chat_message = ChatI(**updated_message)
-            return ApiResponse(type="success", message="Message successfully updated", data=chat_message.model_dump())
+            return ApiResponse(type="success", message="Message successfully updated", data=chat_document(updated_message))
 
+        except ChatStateConflict:
+            raise
         except Exception as e:
-            print(f"Unexpected error in update_chat_message: {str(e)}")
+            logger.exception("Unexpected error in update_chat_message: %s", e)
             return ApiResponse(type="error", message=f"An unexpected error occurred: {str(e)}")
 
 
     def get_step_from_user_message(self, message: MessageInfo, context: str) -> str:
-        for step, step_data in self.chatbot_data.get(context, {}).items():
-            for action in step_data.get('actions', []):
-                if action.get('action_id') == message.action_id:
-                    return step
-        return None  # Return None if no matching step is found
+        flow = self.get_flow(context)
+        if not flow:
+            return None
+        return flow.step_by_action.get(message.action_id)  # None if no matching step is found
     
     def get_step_from_message(self, message: Dict[str, Any], context: str) -> str:
-        message_value = message['message']['value']
-        for step, step_data in self.chatbot_data.get(context, {}).items():
-            if step_data.get('message') == message_value:
-                return step
-        return "STEP_1"  # Default to STEP_1 if not found
+        flow = self.get_flow(context)
+        if not flow:
+            return "STEP_1"
+        return flow.step_by_message.get(message['message']['value'], "STEP_1")  # Default to STEP_1 if not found
     
     
-    async def get_all_chat_messages(self, chat_id: str,context:str) -> ApiResponse:
+    def serialize_messages(self, messages: List[Dict[str, Any]], projection: Optional[Dict[str, int]], fields: Optional[List[str]]) -> List[Dict[str, Any]]:
+        if not projection:
+            return [chat_document(message) for message in messages]
+        # Projected documents are partial, return only what was asked for
+        roots = {name.split(".", 1)[0] for name in fields}
+        return [{key: value for key, value in message.items() if key in roots} for message in messages]
+
+    @traced()
+    async def find_messages(self, query: Dict[str, Any], projection: Optional[Dict[str, int]], direction: int, limit: int) -> List[Dict[str, Any]]:
+        return await self.chatbot_messages.find(query, projection).sort("seq", direction).limit(limit).to_list(length=limit)
+
+    @traced()
+    async def get_all_chat_messages(
+        self,
+        chat_id: str,
+        context: str,
+        limit: int = DEFAULT_PAGE_SIZE,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        chat_state: Optional[Dict[str, Any]] = None
+    ) -> ApiResponse:
         try:
-            messages = await self.chatbot_messages.find({"chat_id": chat_id, "context": context}).sort("created_at", 1).to_list(length=None)
+            if before and after:
+                return ApiResponse(type="error", message="Use either before or after, not both")
+
+            limit = max(1, min(limit, MAX_PAGE_SIZE))
+            query: Dict[str, Any] = {"chat_id": chat_id, "context": context}
+            direction = -1 if before else 1
+            try:
+                if before or after:
+                    query.update(seq_filter(before or after, direction))
+                projection = build_projection(fields, list(ChatI.model_fields))
+            except ValueError as e:
+                return ApiResponse(type="error", message=str(e))
+
+            # One extra document tells whether another page exists, the chat state is read alongside
+            # unless the caller already has it
+            if chat_state is not None:
+                messages, chat_history = await self.find_messages(query, projection, direction, limit + 1), chat_state
+            else:
+                messages, chat_history = await asyncio.gather(
+                    self.find_messages(query, projection, direction, limit + 1),
+                    self.get_chat_state(chat_id)
+                )
+
+            # Discarded messages are usually compacted already, re-read only if the page caught some
+            dead_ranges = chat_history.get("dead_ranges") if chat_history else None
+            if dead_ranges and any(is_dead(message["seq"], dead_ranges) for message in messages):
+                messages = await self.find_messages({**query, **live_filter(dead_ranges)}, projection, direction, limit + 1)
         
-            if not messages:
+            if not messages and not (before or after):
                 return ApiResponse(type="error", message="Chat not found or no messages available")
 
-            chat_messages = [ChatI(**message) for message in messages]
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+            if before:
+                messages.reverse()
+
+            next_cursor = None
+            if has_more:
+                edge = messages[0] if before else messages[-1]
+                next_cursor = encode_seq_cursor(edge["seq"])
 
-            chat_history = await self.chatbot_messages_history.find_one({"chat_id": chat_id})
             has_next = False
 
             if chat_history:
                 current_step = chat_history.get(context)
                 if current_step:
-                    context_data = self.chatbot_data.get(context, {})
-                    steps = list(context_data.keys())
-                    if current_step != steps[-1]:
-                        has_next = True
+                    has_next = not self.is_terminal_step(context, current_step)
 
             return ApiResponse(
                 type="success",
                 data={
-                    "chats": [chat.model_dump() for chat in chat_messages],
-                    "has_next": has_next
+                    "chats": self.serialize_messages(messages, projection, fields),
+                    "has_next": has_next,
+                    "next_cursor": next_cursor
                 }
             )
         except Exception as e:
             return ApiResponse(type="error", message=str(e))
             
-    async def create_chat_message(self, chat_id: str, content: str, chatbot_user_id: str):
-        message = ChatI(
-            from_user=chatbot_user_id,
-            chat_id=chat_id,
-            message=MessageInfo(
-                id=str(uuid4()),
-                type="string",
-                value=content,
-                action_id=None
-            ),
-            created_at=datetime.now(timezone.utc),
-            updated_at=datetime.now(timezone.utc)
-        )
-        await self.chatbot_messages.insert_one(message.model_dump(by_alias=True))
-
+    @traced()
+    async def chat_exists(self, chat_id: str) -> bool:
+        return await self.chatbot_messages_history.find_one({"chat_id": chat_id}, {"_id": 1}) is not None
+
+    async def export_chat_messages(
+        self,
+        chat_id: str,
+        context: Optional[str] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        export_format: str = "ndjson"
+    ) -> AsyncIterator[bytes]:
+        chat_state = await self.get_chat_state(chat_id)
+        query: Dict[str, Any] = {"chat_id": chat_id, **live_filter(chat_state.get("dead_ranges") if chat_state else None)}
+        if context:
+            query["context"] = context
+        if start or end:
+            query["created_at"] = {}
+            if start:
+                query["created_at"]["$gte"] = start
+            if end:
+                query["created_at"]["$lt"] = end
+
+        cursor = self.chatbot_messages.find(query).sort("seq", 1).batch_size(EXPORT_BATCH_SIZE)
+
+        as_array = export_format == "json"
+        separator = b"," if as_array else b"\n"
+        if as_array:
+            yield b"["
+
+        # Documents are flushed per batch, never accumulated for the whole chat
+        buffer: List[bytes] = []
+        first = True
+        async for message in cursor:
+            line = dumps(chat_document(message))
+            if as_array and not first:
+                buffer.append(separator)
+            buffer.append(line)
+            if not as_array:
+                buffer.append(separator)
+            first = False
+            if len(buffer) >= EXPORT_BATCH_SIZE:
+                yield b"".join(buffer)
+                buffer.clear()
+
+        if buffer:
+            yield b"".join(buffer)
+        if as_array:
+            yield b"]"
+
+    @traced()
     async def add_chat_message(self, chat_id: str, message: MessageInfo, user_id: str, context: str, from_message_id: Optional[str] = None) -> ApiResponse:
+        return await self.write_chat(chat_id, lambda _: self._add_chat_message(chat_id, message, user_id, context, from_message_id))
+
+    async def _add_chat_message(self, chat_id: str, message: MessageInfo, user_id: str, context: str, from_message_id: Optional[str] = None) -> ApiResponse:
         try:
             if context not in self.allowed_contexts:
                 return ApiResponse(type="error", message="Invalid Context")
 
-            chat_history = await self.chatbot_messages_history.find_one({"chat_id": chat_id})
+            from_message_uuid, invalid_id = None, None
+            if from_message_id:
+                try:
+                    from_message_uuid = UUID(from_message_id)
+                except ValueError as e:
+                    invalid_id = e
+
+            chat_history, from_message = await self.get_chat_with_message(chat_id, from_message_uuid)
             if not chat_history:
                 return ApiResponse(type="error", message="Chat not found")
 
             current_step = chat_history.get(context)
-            context_data = self.chatbot_data.get(context, {})
-            last_step = list(context_data.keys())[-1]
 
-            if current_step == last_step:
+            if self.is_terminal_step(context, current_step):
                 return ApiResponse(type="error", message="Cannot add message after chat has ended")
 
+            if invalid_id:
+                raise invalid_id
+
+            removed, discarded_state = 0, {}
             if from_message_id:
-                from_message = await self.chatbot_messages.find_one({"chat_id": chat_id, "message.id": UUID(from_message_id)})
-                if from_message:
-                    await self.chatbot_messages.delete_many({
-                        "chat_id": chat_id,
-                        "created_at": {"$gt": from_message['created_at']}
-                    })
+                if from_message and not is_dead(from_message['seq'], chat_history.get("dead_ranges")):
+                    _, removed, discarded_state = self.discard_from(chat_history, from_message['seq'] + 1)
                 else:
                     return ApiResponse(type="error", message="From message not found")
 
@@ -379,190 +790,94 @@ class ChatbotService:
                 updated_at=datetime.now(timezone.utc)
             )
             
-            new_message_dict = new_message.model_dump(by_alias=True)
-            result = await self.chatbot_messages.insert_one(new_message_dict)
-            
-            if not result.inserted_id:
-                return ApiResponse(type="error", message="Failed to add message to chat")
+            new_message_dict = self.to_document(new_message)
+            await self.insert_messages(
+                chat_id, str(user_id), context, [new_message_dict],
+                removed=removed, state=discarded_state, expected_version=chat_history.get("version", 0)
+            )
             
-            return ApiResponse(type="success", data=new_message_dict)
+            # Shaped like the route's ChatI, a stored Idempotency-Key response skips the response model
+            return ApiResponse(type="success", data=chat_document(new_message_dict))
 
+        except ChatStateConflict:
+            raise
         except Exception as e:
             return ApiResponse(type="error", message=str(e))
     
-    async def get_chat(self, chat_id: str) -> ChatI:
+    @traced()
+    async def get_chat_document(self, chat_id: str) -> Optional[Dict[str, Any]]:
         chat = await self.chatbot_messages.find_one({"chat_id": chat_id})
-        if chat:
-            return ChatI(**chat)
-        return None
+        return chat_document(chat) if chat else None
     
     def get_next_step(self, current_step: str, context: str) -> Tuple[bool, Dict[str, Any]]:
-        context_data = self.chatbot_data.get(context, {})
-        steps = list(context_data.keys())
-        current_index = steps.index(current_step) if current_step in steps else -1
-        
-        if current_index < len(steps) - 1:
-            next_step = steps[current_index + 1]
-            step_data = context_data[next_step]
-            return True, {"step": next_step, "data": step_data}
+        flow = self.get_flow(context)
+        next_step = flow.get_next_step(current_step) if flow else None
+        if next_step:
+            return True, {"step": next_step, "data": flow.get_step_data(next_step), "actions": flow.get_actions(next_step)}
         return False, {}
 
-    async def update_chat_history(self, chat_id: str, context: str, step: str):
-        await self.chatbot_messages_history.update_one(
-            {"chat_id": chat_id},
-            {"$set": {context: step}},
-            upsert=True
-        )
 
-    async def get_latest_chat_message(self, chat_id: str, count: int = 1) -> ApiResponse:
+    @traced()
+    async def get_latest_chat_message(self, chat_id: str, count: int = 1, fields: Optional[List[str]] = None) -> ApiResponse:
+        count = max(1, min(count, MAX_PAGE_SIZE))
+        projection = build_projection(fields, list(ChatI.model_fields))
+        chat_state = await self.get_chat_state(chat_id)
         latest_messages_cursor = self.chatbot_messages.find(
-            {"chat_id": chat_id},
-            sort=[("updated_at", -1)]
+            {"chat_id": chat_id, **live_filter(chat_state.get("dead_ranges") if chat_state else None)},
+            projection,
+            sort=[("seq", -1)]
         ).limit(count)
         latest_messages = await latest_messages_cursor.to_list(length=count)
         if latest_messages:
-            chats = [ChatI(**message).model_dump() for message in latest_messages]
+            chats = self.serialize_messages(latest_messages, projection, fields)
             return ApiResponse(type="success", data={"chats": chats})
         else:
             return ApiResponse(type="error", message="No messages found")
 
-    responseByActionId = {
-        "action_step_1_1": lambda self, chat_id, context,chatbot_user_id,user_id: self.handle_action_step_1_1(chat_id, context, chatbot_user_id,user_id),
-        "action_step_1_2": lambda self, chat_id, context, chatbot_user_id,user_id: self.handle_action_step_1_2(chat_id, context, chatbot_user_id,user_id),
-        "action_step_2_1": lambda self, chat_id, context, chatbot_user_id,user_id: self.handle_action_step_2_1(chat_id, context, chatbot_user_id,user_id),
-        "action_step_2_2": lambda self, chat_id, context, chatbot_user_id,user_id: self.handle_action_step_2_2(chat_id, context, chatbot_user_id,user_id),
-    }
-
-    async def handle_action_step_1_1(self, chat_id: str, context: str, chatbot_user_id: str, user_id: str):
-        initial_response = ChatI(
-            from_user=chatbot_user_id,
-            chat_id=chat_id,
-            user_id=user_id,
-            message=MessageInfo(
-                id=str(uuid4()),
-                type="string",
-                value="We have mailed the report to your email address.",
-                action_id=None
-            ),
-            actions=[],
-            created_at=datetime.now(timezone.utc),
-            updated_at=datetime.now(timezone.utc)
-        )
-        await self.chatbot_messages.insert_one(initial_response.model_dump(by_alias=True))
-
-        has_next, result = self.get_next_step("STEP_1", context)
-        next_message = None
-        if has_next:
-            step_data = result.get("data")
-            if step_data and step_data.get("message"):
-                next_message = ChatI(
-                    from_user=chatbot_user_id,
-                    chat_id=chat_id,
-                    user_id=user_id,
-                    message=MessageInfo(
-                        id=str(uuid4()),
-                        type="string",
-                        value=step_data["message"],
-                        action_id=None
-                    ),
-                    actions=[ChatActionI(**action) for action in step_data.get("actions", [])],
-                    created_at=datetime.now(timezone.utc),
-                    updated_at=datetime.now(timezone.utc)
-                )
-                await self.chatbot_messages.insert_one(next_message.model_dump(by_alias=True))
-
-        await self.update_chat_history(chat_id, context, "STEP_2")
-
-        messages = [initial_response.model_dump()]
-        if next_message:
-            messages.append(next_message.model_dump())
-        
-        return messages
-
-    async def handle_action_step_1_2(self, chat_id: str, context: str, chatbot_user_id: str, user_id: str):
-        initial_response = ChatI(
+    def build_bot_message(self, chat_id: str, user_id: str, chatbot_user_id: str, value: str, actions: List[ChatActionI]) -> ChatI:
+        return ChatI(
             from_user=chatbot_user_id,
             chat_id=chat_id,
             user_id=user_id,
             message=MessageInfo(
                 id=str(uuid4()),
                 type="string",
-                value="We have assigned an agent and you will receive the mail.",
+                value=value,
                 action_id=None
             ),
-            actions=[],
+            actions=actions,
             created_at=datetime.now(timezone.utc),
             updated_at=datetime.now(timezone.utc)
         )
-        await self.chatbot_messages.insert_one(initial_response.model_dump(by_alias=True))
-
-        has_next, result = self.get_next_step("STEP_1", context)
-        next_message = None
-        if has_next:
-            step_data = result.get("data")
-            if step_data and step_data.get("message"):
-                next_message = ChatI(
-                    from_user=chatbot_user_id,
-                    chat_id=chat_id,
-                    user_id=user_id,
-                    message=MessageInfo(
-                        id=str(uuid4()),
-                        type="string",
-                        value=step_data["message"],
-                        action_id=None
-                    ),
-                    actions=[ChatActionI(**action) for action in step_data.get("actions", [])],
-                    created_at=datetime.now(timezone.utc),
-                    updated_at=datetime.now(timezone.utc)
-                )
-                await self.chatbot_messages.insert_one(next_message.model_dump(by_alias=True))
-
-        await self.update_chat_history(chat_id, context, "STEP_2")
 
-        messages = [initial_response.model_dump()]
-        if next_message:
-            messages.append(next_message.model_dump())
-        
-        return messages
-
-    async def handle_action_step_2_1(self, chat_id: str, context: str, chatbot_user_id: str, user_id: str):
-        step_data = self.get_step_data(context, "STEP_1")
-        message = ChatI(
-            from_user=chatbot_user_id,
-            chat_id=chat_id,
-            user_id=user_id,
-            message=MessageInfo(
-                id=str(uuid4()),
-                type="string",
-                value=step_data.get("message", ""),
-                action_id=None
-            ),
-            actions=[ChatActionI(**action) for action in step_data.get("actions", [])],
-            created_at=datetime.now(timezone.utc),
-            updated_at=datetime.now(timezone.utc)
+    @traced()
+    async def execute_transition(
+        self,
+        chat_id: str,
+        context: str,
+        transition: Transition,
+        chatbot_user_id: str,
+        user_id: str,
+        expected_version: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        flow = self.get_flow(context)
+        messages: List[ChatI] = []
+
+        if transition.reply:
+            messages.append(self.build_bot_message(chat_id, user_id, chatbot_user_id, transition.reply, []))
+
+        if transition.show_next_prompt:
+            prompt = flow.get_message(transition.next_step)
+            if prompt:
+                messages.append(self.build_bot_message(chat_id, user_id, chatbot_user_id, prompt, list(flow.get_actions(transition.next_step))))
+
+        # The turn's messages go out in one batch, numbered together with the step update
+        documents = [self.to_document(message) for message in messages]
+        # A transition with nothing to say still answers the action, or the next turn would run it again
+        answered = None if documents else {"last_from_bot": True, "last_action_id": None}
+        await self.insert_messages(
+            chat_id, user_id, context, documents, transition.next_step,
+            state=answered, expected_version=expected_version
         )
-        await self.chatbot_messages.insert_one(message.model_dump(by_alias=True))
-        await self.update_chat_history(chat_id, context, "STEP_1")
-        
-        return [message.model_dump()]
 
-    async def handle_action_step_2_2(self, chat_id: str, context: str, chatbot_user_id: str, user_id: str):
-        step_data = self.get_step_data(context, "STEP_3")
-        message = ChatI(
-            from_user=chatbot_user_id,
-            chat_id=chat_id,
-            user_id=user_id,
-            message=MessageInfo(
-                id=str(uuid4()),
-                type="string",
-                value=step_data.get("message", ""),
-                action_id=None
-            ),
-            actions=[ChatActionI(**action) for action in step_data.get("actions", [])],
-            created_at=datetime.now(timezone.utc),
-            updated_at=datetime.now(timezone.utc)
-        )
-        await self.chatbot_messages.insert_one(message.model_dump(by_alias=True))
-        await self.update_chat_history(chat_id, context, "STEP_3")
-        
-        return [message.model_dump()]
\ No newline at end of file
+        return [message.model_dump() for message in messages]
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+logger = logging.getLogger(__name__)
+
+DeadRanges = List[List[int]]
+
+
+def add_dead_range(dead_ranges: DeadRanges, start: int, end: int) -> Tuple[DeadRanges, int]:
+    # A rewind discards a suffix of the chat, so ranges reaching past start are absorbed
+    # into the new one. Returns the new ranges and how many live messages were discarded.
+    if end < start:
+        return [list(dead_range) for dead_range in dead_ranges], 0
+
+    ranges: DeadRanges = []
+    already_dead = 0
+    for lo, hi in dead_ranges:
+        if hi < start:
+            ranges.append([lo, hi])
+            continue
+        if lo < start:
+            ranges.append([lo, start - 1])
+        already_dead += max(0, min(hi, end) - max(lo, start) + 1)
+    ranges.append([start, end])
+    return ranges, (end - start + 1) - already_dead
+
+
+def is_dead(seq: int, dead_ranges: Optional[DeadRanges]) -> bool:
+    return any(lo <= seq <= hi for lo, hi in dead_ranges or ())
+
+
+def live_filter(dead_ranges: Optional[DeadRanges], field: str = "seq") -> Dict[str, Any]:
+    if not dead_ranges:
+        return {}
+    return {"$nor": [{field: {"$gte": lo, "$lte": hi}} for lo, hi in dead_ranges]}
+
+
+class ChatCompactor:
+    # Physically removes the message ranges rewinds marked as dead in the chat state documents
+    def __init__(
+        self,
+        db: AsyncIOMotorDatabase,
+        batch_size: Optional[int] = None,
+        interval: Optional[float] = None,
+        batch_delay: float = 0.05
+    ):
+        self.chat_states = db["chatbot_messages_history"]
+        self.messages = db["chatbot_messages"]
+        self.batch_size = batch_size or int(os.getenv("COMPACTION_BATCH_SIZE", "500"))
+        self.interval = interval or float(os.getenv("COMPACTION_INTERVAL_SECONDS", "5"))
+        self.batch_delay = batch_delay
+        self.removed = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def compact_chat(self, chat_state: Dict[str, Any]) -> int:
+        chat_id = chat_state["chat_id"]
+        removed = 0
+        for lo, hi in chat_state.get("dead_ranges", []):
+            query = {"chat_id": chat_id, "seq": {"$gte": lo, "$lte": hi}}
+            while True:
+                batch = await self.messages.find(query, {"_id": 1}).limit(self.batch_size).to_list(length=self.batch_size)
+                if not batch:
+                    break
+                result = await self.messages.delete_many({"_id": {"$in": [message["_id"] for message in batch]}})
+                removed += result.deleted_count
+                # Spreads large rewinds out instead of issuing one write spike
+                await asyncio.sleep(self.batch_delay)
+            # A range a newer rewind has since merged no longer matches and is left for the next pass
+            await self.chat_states.update_one({"chat_id": chat_id}, {"$pull": {"dead_ranges": [lo, hi]}})
+
+        await self.chat_states.update_one(
+            {"chat_id": chat_id, "dead_ranges": {"$size": 0}},
+            {"$unset": {"compact_pending": ""}}
+        )
+        return removed
+
+    async def compact_once(self) -> int:
+        removed = 0
+        async for chat_state in self.chat_states.find({"compact_pending": True}, {"chat_id": 1, "dead_ranges": 1}):
+            removed += await self.compact_chat(chat_state)
+        self.removed += removed
+        return removed
+
+    async def _run(self):
+        while True:
+            try:
+                removed = await self.compact_once()
+                if removed:
+                    logger.info("Compacted %s discarded chat messages", removed)
+            except Exception as e:
+                logger.error("Chat compaction failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,84 @@
+import abc
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Set
+
+import orjson
+
+from app.serialization import dumps
+from app.services.invalidation import CHAT_EVENT, InvalidationBus
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[str, Dict[str, Any]], None]
+
+
+class HubBackend(abc.ABC):
+    # Moves events between processes; every backend hands them back through deliver()
+    async def start(self, deliver: Deliver):
+        self.deliver = deliver
+
+    @abc.abstractmethod
+    async def publish(self, channel: str, event: Dict[str, Any]):
+        ...
+
+    async def stop(self):
+        pass
+
+
+class InMemoryBackend(HubBackend):
+    async def publish(self, channel: str, event: Dict[str, Any]):
+        self.deliver(channel, event)
+
+
+class BusBackend(HubBackend):
+    # Events reach subscribers connected to any worker. They travel as JSON so every
+    # worker, including the publisher, delivers exactly what the stream will render.
+    def __init__(self, bus: InvalidationBus):
+        self.bus = bus
+
+    async def start(self, deliver: Deliver):
+        await super().start(deliver)
+        self.bus.subscribe(CHAT_EVENT, lambda payload: deliver(payload["channel"], orjson.loads(payload["event"])))
+
+    async def publish(self, channel: str, event: Dict[str, Any]):
+        await self.bus.publish(CHAT_EVENT, {"channel": channel, "event": dumps(event)})
+
+
+class EventHub:
+    def __init__(self, backend: Optional[HubBackend] = None, queue_size: int = 100):
+        self.backend = backend or InMemoryBackend()
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self.dropped = 0
+
+    async def start(self):
+        await self.backend.start(self._deliver)
+
+    async def stop(self):
+        await self.backend.stop()
+
+    async def publish(self, channel: str, event: Dict[str, Any]):
+        await self.backend.publish(channel, event)
+
+    def _deliver(self, channel: str, event: Dict[str, Any]):
+        for queue in self._subscribers.get(channel, ()):
+            if queue.full():
+                # A slow subscriber loses its oldest event rather than blocking the publisher
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(event)
+
+    @asynccontextmanager
+    async def subscribe(self, channel: str) -> AsyncIterator[asyncio.Queue]:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(channel, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            subscribers = self._subscribers.get(channel)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del self._subscribers[channel]
@@ -0,0 +1,246 @@
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, Set, Tuple
+
+from app.models.chatbot_models import ChatActionI
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLOW_PATH = "chatbot.json"
+
+
+class FlowDefinitionError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Transition:
+    action_id: str
+    next_step: str
+    reply: Optional[str] = None
+    show_next_prompt: bool = True
+
+
+@dataclass(frozen=True)
+class CompiledContext:
+    name: str
+    steps: Mapping[str, Mapping[str, Any]]
+    step_order: Tuple[str, ...]
+    first_step: str
+    terminal_step: str
+    next_step: Mapping[str, Optional[str]]
+    step_by_action: Mapping[str, str]
+    step_by_message: Mapping[str, str]
+    actions: Mapping[str, Tuple[ChatActionI, ...]]
+    transitions: Mapping[str, Transition]
+
+    def get_step_data(self, step: str) -> Mapping[str, Any]:
+        return self.steps.get(step, MappingProxyType({}))
+
+    def get_message(self, step: str, default: str = "") -> str:
+        return self.get_step_data(step).get("message", default)
+
+    def get_actions(self, step: str) -> Tuple[ChatActionI, ...]:
+        return self.actions.get(step, ())
+
+    def get_transition(self, action_id: Optional[str]) -> Optional[Transition]:
+        return self.transitions.get(action_id)
+
+    def get_next_step(self, step: str) -> Optional[str]:
+        # Unknown steps restart from the beginning, like the old index() == -1 lookup
+        if step not in self.next_step:
+            return self.first_step
+        return self.next_step[step]
+
+    def is_terminal(self, step: Optional[str]) -> bool:
+        return step == self.terminal_step
+
+    def has_next(self, step: Optional[str]) -> bool:
+        return not self.is_terminal(step) if step else True
+
+
+@dataclass(frozen=True)
+class CompiledFlows:
+    contexts: Mapping[str, CompiledContext]
+    mtime_ns: int = 0
+
+    def get(self, context: str) -> Optional[CompiledContext]:
+        return self.contexts.get(context)
+
+
+def _compile_transition(
+    name: str,
+    step: str,
+    action_id: str,
+    spec: Any,
+    step_order: Tuple[str, ...],
+    next_step: Dict[str, Optional[str]],
+) -> Transition:
+    if not isinstance(spec, dict):
+        raise FlowDefinitionError(f"Action '{name}.{action_id}' has a non-object 'transition'")
+
+    # Without an explicit target the action advances to the following step
+    target = spec.get("next_step", next_step.get(step))
+    if target not in step_order:
+        raise FlowDefinitionError(f"Action '{name}.{action_id}' targets unknown step '{target}'")
+
+    reply = spec.get("reply")
+    if reply is not None and not isinstance(reply, str):
+        raise FlowDefinitionError(f"Action '{name}.{action_id}' has a non-string 'reply'")
+
+    return Transition(
+        action_id=action_id,
+        next_step=target,
+        reply=reply,
+        show_next_prompt=bool(spec.get("show_next_prompt", True)),
+    )
+
+
+def _compile_context(name: str, steps: Any) -> CompiledContext:
+    if not isinstance(steps, dict) or not steps:
+        raise FlowDefinitionError(f"Context '{name}' must be a non-empty object of steps")
+
+    step_order = tuple(steps.keys())
+    frozen_steps: Dict[str, Mapping[str, Any]] = {}
+    next_step: Dict[str, Optional[str]] = {}
+    step_by_action: Dict[str, str] = {}
+    step_by_message: Dict[str, str] = {}
+    actions: Dict[str, Tuple[ChatActionI, ...]] = {}
+    transition_specs: Dict[str, Any] = {}
+
+    for index, step in enumerate(step_order):
+        step_data = steps[step]
+        if not isinstance(step_data, dict):
+            raise FlowDefinitionError(f"Step '{name}.{step}' must be an object")
+
+        message = step_data.get("message")
+        if not isinstance(message, str):
+            raise FlowDefinitionError(f"Step '{name}.{step}' is missing a string 'message'")
+
+        raw_actions = step_data.get("actions", [])
+        if not isinstance(raw_actions, list):
+            raise FlowDefinitionError(f"Step '{name}.{step}' has non-list 'actions'")
+
+        try:
+            step_actions = tuple(ChatActionI(**action) for action in raw_actions)
+        except Exception as e:
+            raise FlowDefinitionError(f"Step '{name}.{step}' has an invalid action: {e}") from e
+
+        for action, raw_action in zip(step_actions, raw_actions):
+            if action.action_id in step_by_action:
+                raise FlowDefinitionError(f"Duplicate action_id '{action.action_id}' in context '{name}'")
+            step_by_action[action.action_id] = step
+            transition_specs[action.action_id] = raw_action.get("transition", {})
+
+        # First step wins on duplicate prompts, matching the previous linear scan
+        step_by_message.setdefault(message, step)
+        next_step[step] = step_order[index + 1] if index + 1 < len(step_order) else None
+        actions[step] = step_actions
+        frozen_steps[step] = MappingProxyType(dict(step_data))
+
+    transitions = {
+        action_id: _compile_transition(name, step, action_id, transition_specs[action_id], step_order, next_step)
+        for action_id, step in step_by_action.items()
+    }
+
+    return CompiledContext(
+        name=name,
+        steps=MappingProxyType(frozen_steps),
+        step_order=step_order,
+        first_step=step_order[0],
+        terminal_step=step_order[-1],
+        next_step=MappingProxyType(next_step),
+        step_by_action=MappingProxyType(step_by_action),
+        step_by_message=MappingProxyType(step_by_message),
+        actions=MappingProxyType(actions),
+        transitions=MappingProxyType(transitions),
+    )
+
+
+def compile_flows(data: Any, mtime_ns: int = 0) -> CompiledFlows:
+    if not isinstance(data, dict) or not data:
+        raise FlowDefinitionError("Flow definition must be a non-empty object of contexts")
+    contexts = {name: _compile_context(name, steps) for name, steps in data.items()}
+    return CompiledFlows(contexts=MappingProxyType(contexts), mtime_ns=mtime_ns)
+
+
+class FlowEngine:
+    def __init__(self, path: Optional[str] = None, poll_interval: float = 2.0):
+        self.path = path or os.getenv("CHATBOT_FLOW_PATH", DEFAULT_FLOW_PATH)
+        self.poll_interval = poll_interval
+        self._flows: Optional[CompiledFlows] = None
+        self._watch_task: Optional[asyncio.Task] = None
+        # The loop only keeps weak references to tasks
+        self._reload_tasks: Set[asyncio.Task] = set()
+        # Called after the watcher picked up a changed definition
+        self.on_reload: Optional[Callable[[], Awaitable[None]]] = None
+
+    @property
+    def flows(self) -> CompiledFlows:
+        if self._flows is None:
+            raise RuntimeError("Flow definitions have not been loaded")
+        return self._flows
+
+    def get_context(self, context: str) -> Optional[CompiledContext]:
+        return self.flows.get(context)
+
+    def load(self) -> CompiledFlows:
+        mtime_ns = os.stat(self.path).st_mtime_ns
+        with open(self.path, "r") as f:
+            flows = compile_flows(json.load(f), mtime_ns)
+        # Single reference swap, readers never observe a half-built index
+        self._flows = flows
+        return flows
+
+    def reload_if_changed(self) -> bool:
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logger.warning("Cannot stat flow definition %s: %s", self.path, e)
+            return False
+
+        if self._flows is not None and mtime_ns == self._flows.mtime_ns:
+            return False
+
+        try:
+            self.load()
+        except (OSError, ValueError) as e:
+            # Keep serving the last good definition
+            logger.error("Failed to reload flow definition %s: %s", self.path, e)
+            return False
+
+        logger.info("Reloaded flow definition from %s", self.path)
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if await asyncio.to_thread(self.reload_if_changed) and self.on_reload is not None:
+                try:
+                    await self.on_reload()
+                except Exception as e:
+                    logger.error("Flow reload hook failed: %s", e)
+
+    def request_reload(self) -> asyncio.Task:
+        # Another worker saw the definition change, check now instead of at the next poll
+        task = asyncio.create_task(asyncio.to_thread(self.reload_if_changed))
+        self._reload_tasks.add(task)
+        task.add_done_callback(self._reload_tasks.discard)
+        return task
+
+    def start_watching(self):
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop_watching(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
@@ -0,0 +1,161 @@
+import asyncio
+import hashlib
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Union
+
+from bson import Binary
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import DuplicateKeyError
+
+from app.schemas import ApiResponse
+from app.serialization import TrustedJSONResponse
+from app.services.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+PENDING = "pending"
+DONE = "done"
+
+
+def fingerprint(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+class IdempotencyStore:
+    # Keeps the first successful response per key, so retried writes replay it instead of running again
+    def __init__(
+        self,
+        db: AsyncIOMotorDatabase,
+        ttl_seconds: Optional[float] = None,
+        cache: Optional[TTLCache] = None,
+        lease_seconds: float = 60.0,
+        wait_seconds: float = 5.0
+    ):
+        self.collection = db["idempotency_keys"]
+        self.ttl_seconds = ttl_seconds or float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+        # The front cache only has to outlive a burst of retries, Mongo holds the key for the full TTL
+        self.cache = cache if cache is not None else TTLCache(
+            max_size=int(os.getenv("IDEMPOTENCY_CACHE_MAX_SIZE", "10000")),
+            ttl_seconds=min(self.ttl_seconds, 300.0)
+        )
+        self.lease_seconds = lease_seconds
+        self.wait_seconds = wait_seconds
+        self.replays = 0
+        self._inflight: Dict[str, asyncio.Event] = {}
+
+    async def execute(
+        self,
+        key: str,
+        request_hash: str,
+        operation: Callable[[], Awaitable[ApiResponse]]
+    ) -> Tuple[Union[bytes, ApiResponse], bool]:
+        # Returns the stored response body and whether it was replayed, or an ApiResponse
+        # when nothing was stored: an error result, a reused key or a key still in progress.
+        # Retries landing on this process while the first attempt runs wait for it, then replay from the cache
+        while (running := self._inflight.get(key)) is not None:
+            await running.wait()
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            return self._replay(cached, request_hash)
+
+        running = self._inflight[key] = asyncio.Event()
+        try:
+            return await self._execute(key, request_hash, operation)
+        finally:
+            del self._inflight[key]
+            running.set()
+
+    async def _execute(
+        self,
+        key: str,
+        request_hash: str,
+        operation: Callable[[], Awaitable[ApiResponse]]
+    ) -> Tuple[Union[bytes, ApiResponse], bool]:
+        stored = await self._claim(key, request_hash)
+        if stored is not None:
+            return stored
+
+        try:
+            result = await operation()
+        except BaseException:
+            await self._release(key)
+            raise
+
+        # Errors aren't kept, the client may fix the request and retry under the same key
+        if result.type != "success":
+            await self._release(key)
+            return result, False
+
+        body = TrustedJSONResponse(result).body
+        await self.collection.update_one(
+            {"_id": key},
+            {"$set": {"status": DONE, "response": Binary(body)}}
+        )
+        self.cache.set(key, (body, request_hash))
+        return body, False
+
+    async def _claim(self, key: str, request_hash: str) -> Optional[Tuple[Union[bytes, ApiResponse], bool]]:
+        # Inserting the key first makes exactly one attempt run the operation, across processes too
+        deadline = asyncio.get_running_loop().time() + self.wait_seconds
+        while True:
+            now = datetime.now(timezone.utc)
+            try:
+                await self.collection.insert_one({
+                    "_id": key,
+                    "status": PENDING,
+                    "request_hash": request_hash,
+                    "claimed_at": now,
+                    "expires_at": now + timedelta(seconds=self.ttl_seconds),
+                })
+                return None
+            except DuplicateKeyError:
+                pass
+
+            existing = await self.collection.find_one({"_id": key})
+            if existing is None:
+                # Released or expired in between, claim it again
+                continue
+            if existing["status"] == DONE:
+                stored = (bytes(existing["response"]), existing["request_hash"])
+                self.cache.set(key, stored)
+                return self._replay(stored, request_hash)
+            if existing["request_hash"] != request_hash:
+                return self._reused(), False
+
+            # A claim whose owner died is taken over once its lease ran out
+            claimed_at = existing["claimed_at"].replace(tzinfo=timezone.utc)
+            if now - claimed_at > timedelta(seconds=self.lease_seconds):
+                taken = await self.collection.update_one(
+                    {"_id": key, "status": PENDING, "claimed_at": existing["claimed_at"]},
+                    {"$set": {"claimed_at": now}}
+                )
+                if taken.modified_count:
+                    return None
+                continue
+
+            if asyncio.get_running_loop().time() >= deadline:
+                return ApiResponse(type="error", message="A request with this Idempotency-Key is still in progress"), False
+            await asyncio.sleep(0.1)
+
+    async def _release(self, key: str):
+        try:
+            await self.collection.delete_one({"_id": key, "status": PENDING})
+        except Exception as e:
+            logger.warning("Could not release idempotency key %s: %s", key, e)
+
+    def _replay(self, stored: Tuple[bytes, str], request_hash: str) -> Tuple[Union[bytes, ApiResponse], bool]:
+        body, stored_hash = stored
+        if stored_hash != request_hash:
+            return self._reused(), False
+        self.replays += 1
+        return body, True
+
+    @staticmethod
+    def _reused() -> ApiResponse:
+        return ApiResponse(type="error", message="Idempotency-Key was already used for a different request")
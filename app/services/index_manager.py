@@ -0,0 +1,175 @@
+import argparse
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_INDEXES: Dict[str, List[IndexModel]] = {
+    "chatbot_messages": [
+        IndexModel([("chat_id", ASCENDING), ("seq", ASCENDING)], name="chat_id_seq"),
+        IndexModel([("chat_id", ASCENDING), ("message.id", ASCENDING)], name="chat_id_message_id"),
+        IndexModel([("chat_id", ASCENDING), ("context", ASCENDING), ("seq", ASCENDING)], name="chat_id_context_seq"),
+    ],
+    "chatbot_messages_history": [
+        IndexModel([("chat_id", ASCENDING)], name="chat_id_unique", unique=True),
+        IndexModel([("compact_pending", ASCENDING)], name="compact_pending", partialFilterExpression={"compact_pending": True}),
+    ],
+    "chat_summaries": [
+        IndexModel([("chat_id", ASCENDING)], name="chat_id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("updated_at", DESCENDING), ("chat_id", DESCENDING)], name="user_id_updated_at_chat_id"),
+    ],
+    "chat_inboxes": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+    ],
+    "idempotency_keys": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "invalidations": [
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=3600),
+    ],
+    "users": [
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+        IndexModel([("is_bot", ASCENDING)], name="is_bot"),
+    ],
+}
+
+
+@dataclass
+class QueryShape:
+    name: str
+    collection: str
+    filter: Dict[str, Any] = field(default_factory=dict)
+    sort: Optional[List[Tuple[str, int]]] = None
+    pipeline: Optional[List[Dict[str, Any]]] = None
+
+
+# One entry per query the services issue; values are placeholders, only the shape matters
+SERVICE_QUERIES: List[QueryShape] = [
+    QueryShape("latest_message", "chatbot_messages", {"chat_id": ""}, [("seq", DESCENDING)]),
+    QueryShape("chat_messages", "chatbot_messages", {"chat_id": "", "context": ""}, [("seq", ASCENDING)]),
+    QueryShape("chat_messages_page", "chatbot_messages", {"chat_id": "", "context": "", "seq": {"$lt": 0}}, [("seq", DESCENDING)]),
+    QueryShape(
+        "export_messages",
+        "chatbot_messages",
+        {"chat_id": "", "created_at": {"$gte": 0, "$lt": 0}},
+        [("seq", ASCENDING)],
+    ),
+    QueryShape("message_by_id", "chatbot_messages", {"chat_id": "", "message.id": ""}),
+    QueryShape("messages_after", "chatbot_messages", {"chat_id": "", "seq": {"$gte": 0}}),
+    QueryShape(
+        "previous_bot_message",
+        "chatbot_messages",
+        {"chat_id": "", "from_user": {"$ne": ""}, "seq": {"$lt": 0}},
+        [("seq", DESCENDING)],
+    ),
+    QueryShape("user_chats", "chat_summaries", {"user_id": ""}, [("updated_at", DESCENDING), ("chat_id", DESCENDING)]),
+    QueryShape("chat_summary", "chat_summaries", {"chat_id": ""}),
+    QueryShape("chat_inbox", "chat_inboxes", {"user_id": ""}),
+    QueryShape("chat_history", "chatbot_messages_history", {"chat_id": ""}),
+    QueryShape("pending_compaction", "chatbot_messages_history", {"compact_pending": True}),
+    QueryShape("dead_messages", "chatbot_messages", {"chat_id": "", "seq": {"$gte": 0, "$lte": 0}}),
+    QueryShape("recent_invalidations", "invalidations", {"created_at": {"$gt": 0}}, [("created_at", ASCENDING)]),
+    QueryShape("user_by_id", "users", {"user_id": ""}),
+    QueryShape("chatbot_user", "users", {"is_bot": True}),
+]
+
+
+def _key_pattern(keys: Any) -> Tuple[Tuple[str, Any], ...]:
+    return tuple((name, direction) for name, direction in keys)
+
+
+def _has_collscan(plan: Any) -> bool:
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(_has_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collscan(value) for value in plan)
+    return False
+
+
+class IndexManager:
+    def __init__(self, db: AsyncIOMotorDatabase, required: Optional[Dict[str, List[IndexModel]]] = None):
+        self.db = db
+        self.required = required if required is not None else REQUIRED_INDEXES
+        self.failed: Dict[str, str] = {}
+
+    async def missing_indexes(self, collection_name: str) -> List[IndexModel]:
+        existing = await self.db[collection_name].index_information()
+        existing_patterns = {_key_pattern(info["key"]) for info in existing.values()}
+        return [
+            model for model in self.required[collection_name]
+            if _key_pattern(model.document["key"].items()) not in existing_patterns
+        ]
+
+    async def ensure_indexes(self) -> Dict[str, List[str]]:
+        # A collection whose indexes can't be built, e.g. existing duplicates under a unique key,
+        # is recorded in failed and the rest are still created
+        created: Dict[str, List[str]] = {}
+        for collection_name in self.required:
+            try:
+                missing = await self.missing_indexes(collection_name)
+                if not missing:
+                    continue
+                names = await self.db[collection_name].create_indexes(missing)
+            except PyMongoError as e:
+                logger.error("Could not create indexes on %s: %s", collection_name, e)
+                self.failed[collection_name] = str(e)
+                continue
+            logger.info("Created indexes on %s: %s", collection_name, ", ".join(names))
+            created[collection_name] = names
+        return created
+
+    async def explain(self, query: QueryShape) -> Dict[str, Any]:
+        collection = self.db[query.collection]
+        if query.pipeline is not None:
+            return await self.db.command(
+                "explain",
+                {"aggregate": query.collection, "pipeline": query.pipeline, "cursor": {}},
+                verbosity="queryPlanner",
+            )
+        cursor = collection.find(query.filter)
+        if query.sort:
+            cursor = cursor.sort(query.sort)
+        return await cursor.limit(1).explain()
+
+    async def check_query_plans(self, queries: Optional[List[QueryShape]] = None) -> List[str]:
+        queries = queries if queries is not None else SERVICE_QUERIES
+        collscans = []
+        for query in queries:
+            plan = await self.explain(query)
+            if _has_collscan(plan):
+                collscans.append(query.name)
+        if collscans:
+            raise RuntimeError(f"Queries fall back to COLLSCAN: {', '.join(collscans)}")
+        return [query.name for query in queries]
+
+
+async def _main(check: bool):
+    from main import get_database_client, get_database
+
+    client = await get_database_client()
+    try:
+        manager = IndexManager(get_database(client))
+        created = await manager.ensure_indexes()
+        print(f"Created: {created or 'nothing, all indexes present'}")
+        for collection_name, error in manager.failed.items():
+            print(f"Failed on {collection_name}: {error}")
+        if check:
+            checked = await manager.check_query_plans()
+            print(f"Verified {len(checked)} queries use an index")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create missing MongoDB indexes")
+    parser.add_argument("--check", action="store_true", help="fail if any service query plans a COLLSCAN")
+    args = parser.parse_args()
+    asyncio.run(_main(args.check))
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import os
+import socket
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+from uuid import uuid4
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+logger = logging.getLogger(__name__)
+
+USER_CHANGED = "user"
+FLOWS_CHANGED = "flows"
+CHAT_EVENT = "chat_event"
+
+MODES = ("off", "auto", "change_stream", "poll")
+SEEN_EVENTS_LIMIT = 10000
+
+Handler = Callable[[Dict[str, Any]], None]
+
+
+class InvalidationBus:
+    # Broadcasts changes to every worker through the invalidations collection. Handlers run in the
+    # publishing process right away, other processes receive the event from a change stream, or
+    # from polling when the deployment has no replica set. With mode "off" events stay in process.
+    def __init__(self, db: AsyncIOMotorDatabase, mode: Optional[str] = None, poll_interval: Optional[float] = None):
+        self.collection = db["invalidations"]
+        self.mode = mode or os.getenv("INVALIDATION_BUS", "off")
+        if self.mode not in MODES:
+            raise ValueError(f"INVALIDATION_BUS must be one of {', '.join(MODES)}")
+        self.poll_interval = poll_interval or float(os.getenv("INVALIDATION_POLL_SECONDS", "1"))
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.active_mode = "local"
+        self.received = 0
+        self._handlers: Dict[str, List[Handler]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def distributed(self) -> bool:
+        return self.mode != "off"
+
+    def subscribe(self, topic: str, handler: Handler):
+        self._handlers.setdefault(topic, []).append(handler)
+
+    async def publish(self, topic: str, payload: Dict[str, Any]):
+        self._dispatch(topic, payload)
+        if self.distributed:
+            await self.collection.insert_one({
+                "topic": topic,
+                "payload": payload,
+                "origin": self.origin,
+                "created_at": datetime.now(timezone.utc),
+            })
+
+    def _dispatch(self, topic: str, payload: Dict[str, Any]):
+        for handler in self._handlers.get(topic, ()):
+            try:
+                handler(payload)
+            except Exception as e:
+                logger.error("Invalidation handler for %s failed: %s", topic, e)
+
+    def _receive(self, event: Dict[str, Any]):
+        # The publisher already ran its own handlers
+        if event.get("origin") == self.origin:
+            return
+        self.received += 1
+        self._dispatch(event["topic"], event["payload"])
+
+    async def start(self):
+        if not self.distributed or self._task is not None:
+            return
+        stream = None
+        if self.mode in ("auto", "change_stream"):
+            try:
+                stream = self.collection.watch([{"$match": {"operationType": "insert"}}])
+                await stream.__aenter__()
+            except Exception as e:
+                if self.mode == "change_stream":
+                    raise
+                # Change streams need a replica set, a standalone server only supports polling
+                logger.info("Change streams unavailable (%s), polling for invalidations", e)
+                stream = None
+        if stream is not None:
+            self.active_mode = "change_stream"
+            self._task = asyncio.create_task(self._watch(stream))
+        else:
+            self.active_mode = "poll"
+            self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self, stream):
+        resume_token = None
+        while True:
+            try:
+                async with stream:
+                    async for change in stream:
+                        resume_token = change["_id"]
+                        self._receive(change["fullDocument"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Invalidation change stream failed, reopening: %s", e)
+                await asyncio.sleep(self.poll_interval)
+            # Resuming picks up the events published while the stream was down
+            stream = self.collection.watch([{"$match": {"operationType": "insert"}}], resume_after=resume_token)
+
+    async def _poll(self):
+        # Publishers stamp events with their own clocks, the overlap absorbs skew and slow inserts
+        # and already seen events are skipped
+        overlap = timedelta(seconds=max(5.0, self.poll_interval * 2))
+        since = datetime.now(timezone.utc)
+        seen: "OrderedDict[Any, None]" = OrderedDict()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            started = datetime.now(timezone.utc)
+            try:
+                async for event in self.collection.find({"created_at": {"$gt": since - overlap}}).sort("created_at", 1):
+                    if event["_id"] in seen:
+                        continue
+                    seen[event["_id"]] = None
+                    if len(seen) > SEEN_EVENTS_LIMIT:
+                        seen.popitem(last=False)
+                    self._receive(event)
+                since = started
+            except Exception as e:
+                logger.warning("Polling for invalidations failed: %s", e)
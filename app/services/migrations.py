@@ -0,0 +1,127 @@
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+
+async def _bump_inboxes(db: AsyncIOMotorDatabase, user_ids) -> None:
+    # Chat lists cached under the old inbox version would miss the backfilled summaries
+    if user_ids:
+        await db["chat_inboxes"].bulk_write(
+            [UpdateOne({"user_id": user_id}, {"$inc": {"version": 1}}, upsert=True) for user_id in user_ids],
+            ordered=False
+        )
+
+
+async def backfill_chat_summaries(db: AsyncIOMotorDatabase) -> int:
+    # Builds the chat_summaries documents for chats written before the collection existed
+    pipeline = [
+        {"$sort": {"chat_id": 1, "created_at": -1, "_id": -1}},
+        {"$group": {
+            "_id": "$chat_id",
+            "user_id": {"$first": "$user_id"},
+            "last_message": {"$first": "$$ROOT"},
+            "message_count": {"$sum": 1},
+        }},
+        {"$lookup": {
+            "from": "chatbot_messages_history",
+            "localField": "_id",
+            "foreignField": "chat_id",
+            "as": "history",
+        }},
+    ]
+
+    written = 0
+    operations = []
+    user_ids = set()
+    async for chat in db["chatbot_messages"].aggregate(pipeline, allowDiskUse=True):
+        history = chat["history"][0] if chat["history"] else {}
+        context = chat["last_message"].get("context", "ONBOARDING")
+        user_ids.add(chat["user_id"])
+        operations.append(UpdateOne(
+            {"chat_id": chat["_id"]},
+            {"$setOnInsert": {
+                "user_id": chat["user_id"],
+                "last_message": chat["last_message"],
+                "message_count": chat["message_count"],
+                "context": context,
+                "current_step": history.get(context),
+                "updated_at": chat["last_message"].get("updated_at", datetime.now(timezone.utc)),
+            }},
+            upsert=True,
+        ))
+        if len(operations) >= BATCH_SIZE:
+            result = await db["chat_summaries"].bulk_write(operations, ordered=False)
+            written += result.upserted_count
+            await _bump_inboxes(db, user_ids)
+            operations = []
+            user_ids = set()
+
+    if operations:
+        result = await db["chat_summaries"].bulk_write(operations, ordered=False)
+        written += result.upserted_count
+        await _bump_inboxes(db, user_ids)
+    return written
+
+
+async def backfill_message_seq(db: AsyncIOMotorDatabase) -> int:
+    # Numbers the messages of chats written before messages carried a per-chat seq.
+    # Every message of such a chat is renumbered in created_at order, including any
+    # already numbered since, and the chat's counter is moved past the last one.
+    messages = db["chatbot_messages"]
+    pipeline = [
+        {"$match": {"seq": {"$exists": False}}},
+        {"$group": {"_id": "$chat_id"}},
+    ]
+
+    written = 0
+    async for chat in messages.aggregate(pipeline, allowDiskUse=True):
+        chat_id = chat["_id"]
+        seq = 0
+        operations = []
+        async for message in messages.find({"chat_id": chat_id}, {"_id": 1}).sort([("created_at", 1), ("_id", 1)]):
+            seq += 1
+            operations.append(UpdateOne({"_id": message["_id"]}, {"$set": {"seq": seq}}))
+            if len(operations) >= BATCH_SIZE:
+                result = await messages.bulk_write(operations, ordered=False)
+                written += result.modified_count
+                operations = []
+
+        if operations:
+            result = await messages.bulk_write(operations, ordered=False)
+            written += result.modified_count
+        await db["chatbot_messages_history"].update_one({"chat_id": chat_id}, {"$max": {"seq": seq}}, upsert=True)
+    return written
+
+
+MIGRATIONS = {
+    "chat_summaries": backfill_chat_summaries,
+    "message_seq": backfill_message_seq,
+}
+
+
+async def _main(names):
+    from main import get_database_client, get_database
+
+    client = await get_database_client()
+    try:
+        db = get_database(client)
+        for name in names or list(MIGRATIONS):
+            count = await MIGRATIONS[name](db)
+            print(f"{name}: {count} documents written")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill derived collections for existing chats")
+    parser.add_argument("names", nargs="*", choices=list(MIGRATIONS), help="migrations to run, all by default")
+    args = parser.parse_args()
+    asyncio.run(_main(args.names))
@@ -0,0 +1,91 @@
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+DEFAULT_CHATS_PAGE_SIZE = 50
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _to_millis(value: datetime) -> int:
+    if value.tzinfo is None:
+        # Motor hands back naive datetimes that are already UTC
+        value = value.replace(tzinfo=timezone.utc)
+    return (value - EPOCH) // timedelta(milliseconds=1)
+
+
+def _encode(payload: Dict[str, Any]) -> str:
+    raw = json.dumps(payload, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode(cursor: str) -> Dict[str, Any]:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    if not isinstance(payload, dict):
+        raise TypeError("Cursor payload must be an object")
+    return payload
+
+
+def encode_cursor(value: datetime, tiebreaker: Any) -> str:
+    return _encode({"t": _to_millis(value), "i": str(tiebreaker)})
+
+
+def decode_cursor(cursor: str, tiebreaker_type: Callable[[str], Any] = ObjectId) -> Tuple[datetime, Any]:
+    try:
+        payload = _decode(cursor)
+        return EPOCH + timedelta(milliseconds=int(payload["t"])), tiebreaker_type(payload["i"])
+    except (ValueError, KeyError, TypeError, InvalidId) as e:
+        raise InvalidCursor("Invalid cursor") from e
+
+
+def encode_seq_cursor(seq: int) -> str:
+    return _encode({"s": seq})
+
+
+def decode_seq_cursor(cursor: str) -> int:
+    try:
+        return int(_decode(cursor)["s"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise InvalidCursor("Invalid cursor") from e
+
+
+def keyset_filter(
+    cursor: str,
+    direction: int,
+    field: str = "created_at",
+    tiebreaker_field: str = "_id",
+    tiebreaker_type: Callable[[str], Any] = ObjectId
+) -> Dict[str, Any]:
+    value, tiebreaker = decode_cursor(cursor, tiebreaker_type)
+    op = "$gt" if direction > 0 else "$lt"
+    return {"$or": [
+        {field: {op: value}},
+        {field: value, tiebreaker_field: {op: tiebreaker}},
+    ]}
+
+
+def seq_filter(cursor: str, direction: int, field: str = "seq") -> Dict[str, Any]:
+    # seq is unique within a chat, so no tiebreaker is needed
+    op = "$gt" if direction > 0 else "$lt"
+    return {field: {op: decode_seq_cursor(cursor)}}
+
+
+def build_projection(fields: Optional[List[str]], allowed: List[str]) -> Optional[Dict[str, int]]:
+    if not fields:
+        return None
+    for name in fields:
+        if name.split(".", 1)[0] not in allowed:
+            raise ValueError(f"Unknown field '{name}'")
+    # The cursor key is always fetched so the next page can be addressed
+    return {**{name: 1 for name in fields}, "seq": 1}
@@ -1,32 +1,76 @@
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from app.models.user_models import UserInDB, UserCreate, UserResponse
 from app.schemas import ApiResponse
-from typing import List
+from app.services.cache import TTLCache
+from app.services.invalidation import USER_CHANGED, InvalidationBus
+from app.tracing import traced
+from typing import List, Optional, Dict, Any
 from uuid import UUID
+import os
+
+CHATBOT_USER_KEY = ("bot",)
+
+_user_cache: Optional[TTLCache] = None
+
+def get_user_cache() -> TTLCache:
+    # Created on first use so the settings are read after the .env file is loaded
+    global _user_cache
+    if _user_cache is None:
+        _user_cache = TTLCache(
+            max_size=int(os.getenv("USER_CACHE_MAX_SIZE", "10000")),
+            ttl_seconds=float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+        )
+    return _user_cache
 
 class UserService:
-    def __init__(self, db: AsyncIOMotorDatabase):
+    def __init__(self, db: AsyncIOMotorDatabase, cache: Optional[TTLCache] = None, bus: Optional[InvalidationBus] = None):
         self.collection = db['users']
+        self.cache = cache if cache is not None else get_user_cache()
+        self.bus = bus
+        if bus is not None:
+            # Other workers drop their cached copy when a user changes here
+            bus.subscribe(USER_CHANGED, lambda payload: self.invalidate_user(UUID(payload["user_id"]), payload["is_bot"]))
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return self.cache.stats()
+
+    def invalidate_user(self, user_id: UUID, is_bot: bool = False):
+        self.cache.invalidate(("user", user_id))
+        if is_bot:
+            self.cache.invalidate(CHATBOT_USER_KEY)
+
+    @traced()
+    async def _load_user(self, query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        user = await self.collection.find_one(query)
+        if not user:
+            return None
+        return UserResponse.from_db_model(UserInDB(**user)).model_dump()
 
+    @traced()
     async def create_user(self, user: UserCreate) -> ApiResponse:
         try:
             user_in_db = UserInDB(**user.model_dump())
             result = await self.collection.insert_one(user_in_db.model_dump())
             created_user = await self.collection.find_one({"_id": result.inserted_id})
+            self.invalidate_user(user_in_db.user_id, user_in_db.is_bot)
+            if self.bus is not None:
+                await self.bus.publish(USER_CHANGED, {"user_id": str(user_in_db.user_id), "is_bot": user_in_db.is_bot})
             return ApiResponse(type="success", data=UserResponse.from_db_model(UserInDB(**created_user)).model_dump())
         except Exception as e:
             return ApiResponse(type="error", message=str(e))
 
+    @traced()
     async def get_user(self, user_id: UUID) -> ApiResponse:
         try:
-            user = await self.collection.find_one({"user_id": user_id})
+            user = await self.cache.get_or_load(("user", user_id), lambda: self._load_user({"user_id": user_id}))
             if user:
-                return ApiResponse(type="success", data=UserResponse.from_db_model(UserInDB(**user)).model_dump())
+                return ApiResponse(type="success", data=dict(user))
             else:
                 return ApiResponse(type="error", message="User not found")
         except Exception as e:
             return ApiResponse(type="error", message=str(e))
 
+    @traced()
     async def get_all_users(self) -> ApiResponse:
         try:
             users = await self.collection.find().to_list(length=None)
@@ -35,11 +79,12 @@ class UserService:
         except Exception as e:
             return ApiResponse(type="error", message=str(e))
 
+    @traced()
     async def get_chatbot_user(self) -> ApiResponse:
         try:
-            chatbot_user = await self.collection.find_one({"is_bot": True})
+            chatbot_user = await self.cache.get_or_load(CHATBOT_USER_KEY, lambda: self._load_user({"is_bot": True}))
             if chatbot_user:
-                return ApiResponse(type="success", data=UserResponse.from_db_model(UserInDB(**chatbot_user)).model_dump())
+                return ApiResponse(type="success", data=dict(chatbot_user))
             else:
                 return ApiResponse(type="error", message="Chatbot user not found")
         except Exception as e:
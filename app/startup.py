@@ -0,0 +1,62 @@
+import logging
+import time
+from typing import Any, Awaitable, Dict, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class StartupReport:
+    # Records how long each startup phase took and whether the app may receive traffic
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.ready = False
+        self.draining = False
+        self.error: Optional[str] = None
+        self.warnings: List[str] = []
+        self._started = time.perf_counter()
+        self.total_ms: Optional[float] = None
+
+    async def run(self, name: str, step: Awaitable[T]) -> T:
+        started = time.perf_counter()
+        try:
+            return await step
+        finally:
+            self.phases[name] = round((time.perf_counter() - started) * 1000, 1)
+            logger.info("Startup phase %s took %.1fms", name, self.phases[name])
+
+    def warn(self, message: str):
+        # Problems the app can serve traffic with, reported by /readyz
+        self.warnings.append(message)
+        logger.warning("Startup: %s", message)
+
+    def mark_ready(self):
+        self.total_ms = round((time.perf_counter() - self._started) * 1000, 1)
+        self.ready = True
+        logger.info("Startup finished in %.1fms", self.total_ms)
+
+    def mark_failed(self, error: BaseException):
+        self.error = str(error)
+        self.ready = False
+
+    def mark_draining(self):
+        self.ready = False
+        self.draining = True
+
+    @property
+    def status(self) -> str:
+        if self.ready:
+            return "ready"
+        if self.error:
+            return "failed"
+        return "draining" if self.draining else "starting"
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "status": self.status,
+            "phases_ms": self.phases,
+            "total_ms": self.total_ms,
+            "error": self.error,
+            "warnings": self.warnings,
+        }
@@ -0,0 +1,355 @@
+import abc
+import functools
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+import orjson
+from pymongo import monitoring
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "at-chatbot-backend"
+TRACEPARENT_HEADER = b"traceparent"
+# OTLP span kinds and status codes
+KIND_INTERNAL, KIND_SERVER, KIND_CLIENT = 1, 2, 3
+STATUS_ERROR = 2
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class Trace:
+    __slots__ = ("trace_id", "sampled", "spans")
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans: List["Span"] = []
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str] = None, kind: int = KIND_INTERNAL, start_ns: Optional[int] = None):
+        self.trace = trace
+        self.span_id = random.getrandbits(64).to_bytes(8, "big").hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+
+    def child(self, name: str, kind: int = KIND_INTERNAL) -> "Span":
+        return Span(self.trace, name, self.span_id, kind)
+
+    def finish(self, end_ns: Optional[int] = None):
+        self.end_ns = end_ns or time.time_ns()
+        # Spans finish on driver threads too, list.append is atomic
+        self.trace.spans.append(self)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error is not None:
+            span["status"] = {"code": STATUS_ERROR, "message": self.error}
+        return span
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def otlp_request(traces: List[Trace]) -> Dict[str, Any]:
+    # The OTLP/JSON ExportTraceServiceRequest layout collectors accept on /v1/traces
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [span.to_otlp() for trace in traces for span in trace.spans],
+            }],
+        }]
+    }
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def traced(name: Optional[str] = None) -> Callable[[F], F]:
+    # Wraps a coroutine function in a child span of whatever span is current, a no-op outside traced requests
+    def decorator(func: F) -> F:
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            parent = _current_span.get()
+            if parent is None:
+                return await func(*args, **kwargs)
+            span = parent.child(span_name)
+            token = _current_span.set(span)
+            try:
+                return await func(*args, **kwargs)
+            except BaseException as e:
+                span.error = type(e).__name__
+                raise
+            finally:
+                _current_span.reset(token)
+                span.finish()
+
+        return wrapper
+    return decorator
+
+
+def parse_traceparent(value: str) -> Optional[Tuple[str, str, bool]]:
+    # W3C trace context: version-trace_id-parent_id-flags
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+    return parts[1], parts[2], sampled
+
+
+class SpanExporter(abc.ABC):
+    # Traces are queued by the request and written out by a daemon thread, so exporting never blocks the loop
+    def __init__(self, max_queue: int = 2048, batch_size: int = 64):
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue: "queue.Queue[Optional[Trace]]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+            self._thread.start()
+
+    def export(self, trace: Trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self, timeout: float = 5.0):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            trace = self._queue.get()
+            batch = [trace] if trace is not None else []
+            while trace is not None and len(batch) < self.batch_size:
+                try:
+                    trace = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if trace is not None:
+                    batch.append(trace)
+            if batch:
+                try:
+                    self.write(batch)
+                except Exception as e:
+                    logger.warning("Could not export %s traces: %s", len(batch), e)
+            if trace is None:
+                return
+
+    @abc.abstractmethod
+    def write(self, batch: List[Trace]):
+        ...
+
+
+class FileSpanExporter(SpanExporter):
+    # One OTLP/JSON request per line, so the file can be replayed into a collector or read with jq
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    def write(self, batch: List[Trace]):
+        with open(self.path, "ab") as f:
+            for trace in batch:
+                f.write(orjson.dumps(otlp_request([trace])) + b"\n")
+
+
+class OtlpHttpSpanExporter(SpanExporter):
+    def __init__(self, endpoint: str, timeout: float = 5.0, **kwargs):
+        super().__init__(**kwargs)
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def write(self, batch: List[Trace]):
+        request = urllib.request.Request(
+            self.endpoint,
+            data=orjson.dumps(otlp_request(batch)),
+            headers={"Content-Type": "application/json"},
+            method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+class Tracer:
+    def __init__(
+        self,
+        exporter: Optional[SpanExporter] = None,
+        sample_rate: Optional[float] = None,
+        slow_ms: Optional[float] = None
+    ):
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+        # Traces slower than this are kept even when the sampler skipped them
+        self.slow_ms = slow_ms if slow_ms is not None else float(os.getenv("TRACE_SLOW_MS", "0"))
+        self.exporter = exporter if exporter is not None else self._exporter_from_env()
+
+    @staticmethod
+    def _exporter_from_env() -> SpanExporter:
+        endpoint = os.getenv("TRACE_OTLP_ENDPOINT")
+        if endpoint:
+            return OtlpHttpSpanExporter(endpoint)
+        return FileSpanExporter(os.getenv("TRACE_EXPORT_PATH", "traces.jsonl"))
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.slow_ms > 0
+
+    def start(self):
+        if self.enabled:
+            self.exporter.start()
+
+    def stop(self):
+        self.exporter.stop()
+
+    def start_trace(self, name: str, traceparent: Optional[str] = None) -> Optional[Span]:
+        if not self.enabled:
+            return None
+        parent = parse_traceparent(traceparent) if traceparent else None
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id = random.getrandbits(128).to_bytes(16, "big").hex(), None
+            sampled = random.random() < self.sample_rate
+        if not sampled and self.slow_ms <= 0:
+            return None
+        return Span(Trace(trace_id, sampled), name, parent_id, KIND_SERVER)
+
+    def finish_trace(self, root: Span, end_ns: Optional[int] = None):
+        root.finish(end_ns)
+        if root.trace.sampled or root.duration_ms >= self.slow_ms:
+            self.exporter.export(root.trace)
+
+
+class MongoTracingListener(monitoring.CommandListener):
+    # Motor runs commands on executor threads with a copy of the caller's context, so the current span is the caller's
+    def __init__(self):
+        self._spans: Dict[Tuple[Any, int], Span] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        parent = _current_span.get()
+        if parent is None:
+            return
+        span = parent.child(f"mongodb.{event.command_name}", KIND_CLIENT)
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        span.attributes.update({
+            "db.system": "mongodb",
+            "db.name": event.database_name,
+            "db.operation": event.command_name,
+            "db.mongodb.collection": target if isinstance(target, str) else "",
+        })
+        self._spans[(event.connection_id, event.request_id)] = span
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        span = self._spans.pop((event.connection_id, event.request_id), None)
+        if span is not None:
+            span.finish(span.start_ns + event.duration_micros * 1000)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        span = self._spans.pop((event.connection_id, event.request_id), None)
+        if span is not None:
+            span.error = str(event.failure.get("errmsg", "command failed"))
+            span.finish(span.start_ns + event.duration_micros * 1000)
+
+
+class TracingMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        tracer: Optional[Tracer] = getattr(scope["app"].state, "tracer", None) if scope["type"] == "http" else None
+        traceparent = None
+        if tracer is not None and tracer.enabled:
+            for name, value in scope["headers"]:
+                if name == TRACEPARENT_HEADER:
+                    traceparent = value.decode("latin-1")
+                    break
+        root = tracer.start_trace(scope.get("method", ""), traceparent) if tracer is not None else None
+        if root is None:
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        responded_ns: Optional[int] = None
+
+        async def send_wrapper(message: Message):
+            nonlocal status, responded_ns
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            # The root ends with the response; spans of background tasks after it are still exported as its children
+            if message["type"] == "http.response.body" and not message.get("more_body", False) and responded_ns is None:
+                responded_ns = time.time_ns()
+
+        token = _current_span.set(root)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            root.error = type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            route = scope.get("route")
+            route_path = route.path if route is not None else scope["path"]
+            root.name = f"{scope['method']} {route_path}"
+            root.attributes.update({
+                "http.method": scope["method"],
+                "http.route": route_path,
+                "http.status_code": status,
+                "user.id": scope.get("state", {}).get("user_id", ""),
+            })
+            if status >= 500 and root.error is None:
+                root.error = f"HTTP {status}"
+            tracer.finish_trace(root, responded_ns)
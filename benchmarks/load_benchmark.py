@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from uuid import UUID, uuid4
+
+import httpx
+
+DEFAULT_MONGODB_URL = "mongodb://localhost:27017"
+DEFAULT_DATABASE = "artisan_benchmark"
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    # Nearest-rank, so every reported value is an observed latency
+    ordered = sorted(samples)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, route: str, elapsed: float, ok: bool):
+        self.samples.setdefault(route, []).append(elapsed)
+        if not ok:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, wall_seconds: float) -> Dict[str, Any]:
+        routes = {}
+        for route, samples in sorted(self.samples.items()):
+            routes[route] = {
+                "count": len(samples),
+                "errors": self.errors.get(route, 0),
+                "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+                **{f"p{pct}_ms": round(percentile(samples, pct) * 1000, 3) for pct in PERCENTILES},
+                "max_ms": round(max(samples) * 1000, 3),
+            }
+        total = sum(len(samples) for samples in self.samples.values())
+        return {
+            "requests": total,
+            "errors": sum(self.errors.values()),
+            "wall_seconds": round(wall_seconds, 3),
+            "throughput_rps": round(total / wall_seconds, 1) if wall_seconds else None,
+            "routes": routes,
+        }
+
+
+class Conversation:
+    # One user's scripted walk through the onboarding flow, timing every call by route
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, user_id: str):
+        self.client = client
+        self.recorder = recorder
+        self.headers = {"User-ID": user_id}
+
+    async def call(self, route: str, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        started = time.perf_counter()
+        response = await self.client.request(method, "/api/v1/chatbot" + path, json=body, headers=self.headers)
+        elapsed = time.perf_counter() - started
+        payload = response.json() if response.headers.get("content-type", "").startswith("application/json") else {}
+        self.recorder.record(route, elapsed, response.status_code == 200 and payload.get("type") == "success")
+        return payload
+
+    def message(self, value: str, action_id: Optional[str] = None) -> Dict[str, Any]:
+        return {"type": "string", "value": value, "action_id": action_id}
+
+    async def add(self, chat_id: str, value: str, action_id: Optional[str] = None) -> Dict[str, Any]:
+        return await self.call("add_chat", "POST", f"/{chat_id}/add_chat", {
+            "context": "ONBOARDING",
+            "message": self.message(value, action_id),
+        })
+
+    async def respond(self, chat_id: str):
+        await self.call("get_response", "POST", f"/{chat_id}/get_response", {"context": "ONBOARDING"})
+
+    async def run(self):
+        created = await self.call("create_chat", "POST", "/create_chat")
+        chat_id = created["data"]["chat_id"]
+        await self.respond(chat_id)
+
+        await self.add(chat_id, "Generate report", "action_step_1_1")
+        await self.respond(chat_id)
+
+        typed = await self.add(chat_id, "hello")
+        await self.respond(chat_id)
+        await self.call("update_chat_message", "PUT", f"/{chat_id}/update_chat_message", {
+            "context": "ONBOARDING",
+            "message_id": typed["data"]["message"]["id"],
+            "message": self.message("hello again"),
+        })
+
+        await self.add(chat_id, "Yes", "action_step_2_1")
+        await self.respond(chat_id)
+        assigned = await self.add(chat_id, "Assign", "action_step_1_2")
+        await self.call("delete_chat_message", "DELETE", f"/{chat_id}/delete_chat_message", {
+            "context": "ONBOARDING",
+            "message_id": assigned["data"]["message"]["id"],
+        })
+        await self.add(chat_id, "Assign", "action_step_1_2")
+        await self.respond(chat_id)
+
+        await self.call("get_user_chats", "GET", "/")
+        await self.call("get_all_chat_messages", "POST", f"/{chat_id}", {"context": "ONBOARDING"})
+
+        await self.add(chat_id, "No", "action_step_2_2")
+        await self.respond(chat_id)
+
+
+async def seed(app: Any, users: int, seed_chats: int) -> List[str]:
+    from app.controllers.chatbot_controllers import CHATBOT_USER_ID
+    from app.models.user_models import UserInDB
+
+    db = app.state.mongodb
+    await db["users"].update_one(
+        {"user_id": UUID(CHATBOT_USER_ID)},
+        {"$setOnInsert": UserInDB(user_id=UUID(CHATBOT_USER_ID), name="Ava", profile_image="", is_bot=True).model_dump()},
+        upsert=True
+    )
+    user_ids = [uuid4() for _ in range(users)]
+    await db["users"].insert_many([
+        UserInDB(user_id=user_id, name=f"benchmark-{i}", profile_image="").model_dump()
+        for i, user_id in enumerate(user_ids)
+    ])
+
+    # Existing chats size the inbox and the collections the measured requests hit
+    chatbot_service = app.state.chatbot_service
+    for user_id in user_ids:
+        await asyncio.gather(*(chatbot_service.create_chat(CHATBOT_USER_ID, str(user_id)) for _ in range(seed_chats)))
+    return [str(user_id) for user_id in user_ids]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any]):
+    print(f"\n{'route':<24} {'p50 base':>10} {'p50 now':>10} {'p95 base':>10} {'p95 now':>10}")
+    for route, stats in result["routes"].items():
+        base = baseline.get("routes", {}).get(route)
+        if not base:
+            continue
+        print(f"{route:<24} {base['p50_ms']:>10.2f} {stats['p50_ms']:>10.2f} {base['p95_ms']:>10.2f} {stats['p95_ms']:>10.2f}")
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    os.environ["MONGODB_URL"] = args.mongodb_url
+    os.environ["MONGODB_DATABASE"] = args.database
+    # Every simulated user runs flat out, the per-user limit would measure itself
+    os.environ.setdefault("RATE_LIMIT_PER_SECOND", "0")
+    from main import app
+    from app.services.index_manager import IndexManager
+
+    async with app.router.lifespan_context(app):
+        # Every run starts from an empty database, dropping it also removed the startup indexes
+        await app.state.mongodb_client.drop_database(args.database)
+        await IndexManager(app.state.mongodb).ensure_indexes()
+
+        user_ids = await seed(app, args.concurrency, args.seed_chats)
+        recorder = Recorder()
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            if args.warmup:
+                await Conversation(client, Recorder(), user_ids[0]).run()
+
+            async def worker(user_id: str):
+                for _ in range(args.conversations):
+                    await Conversation(client, recorder, user_id).run()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(user_id) for user_id in user_ids))
+            wall_seconds = time.perf_counter() - started
+
+        if not args.keep:
+            await app.state.mongodb_client.drop_database(args.database)
+
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "concurrency": args.concurrency,
+            "conversations": args.conversations,
+            "seed_chats": args.seed_chats,
+        },
+        **recorder.summary(wall_seconds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive scripted chatbot conversations through the app and report latency per route")
+    parser.add_argument("--concurrency", type=int, default=10, help="simultaneous users, each running conversations back to back")
+    parser.add_argument("--conversations", type=int, default=5, help="conversations per user")
+    parser.add_argument("--seed-chats", type=int, default=20, help="existing chats created per user before measuring")
+    parser.add_argument("--mongodb-url", default=os.getenv("BENCHMARK_MONGODB_URL", DEFAULT_MONGODB_URL))
+    parser.add_argument("--database", default=DEFAULT_DATABASE, help="dropped before the run, and after it unless --keep is given")
+    parser.add_argument("--keep", action="store_true", help="leave the benchmark data in place after the run")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false", help="skip the unmeasured warm-up conversation")
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    parser.add_argument("--compare", help="earlier results JSON to compare percentiles against")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+
+    print(f"{result['requests']} requests, {result['errors']} errors, {result['throughput_rps']} req/s")
+    print(f"{'route':<24} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for route, stats in result["routes"].items():
+        print(
+            f"{route:<24} {stats['count']:>6} {stats['errors']:>6} "
+            f"{stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f} {stats['max_ms']:>9.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
+from uuid import uuid4
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from app.models.chatbot_models import ChatI
+from app.schemas import ApiResponse
+from app.serialization import TrustedJSONResponse, chat_document
+
+
+def make_documents(count: int) -> List[Dict[str, Any]]:
+    user_id, bot_id, chat_id = str(uuid4()), str(uuid4()), str(uuid4())
+    start = datetime(2024, 1, 1)
+    documents = []
+    for i in range(count):
+        created_at = start + timedelta(seconds=i)
+        documents.append({
+            "_id": ObjectId(),
+            "from_user": bot_id if i % 2 == 0 else user_id,
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "context": "ONBOARDING",
+            "created_at": created_at,
+            "updated_at": created_at,
+            "message": {"type": "string", "value": f"message {i}", "action_id": None, "id": str(uuid4())},
+            "actions": [
+                {"type": "BUTTON", "value": "Generate report", "action_id": "1_1"},
+                {"type": "BUTTON", "value": "Assign", "action_id": "1_2"},
+            ] if i % 2 == 0 else [],
+        })
+    return documents
+
+
+response_adapter = TypeAdapter(ApiResponse[Dict[str, Any]])
+
+
+def validated_path(documents: List[Dict[str, Any]]) -> bytes:
+    # What the history route did before: build ChatI models, then let FastAPI
+    # validate the response_model, encode it and json.dumps the result
+    chats = [ChatI(**document).model_dump() for document in documents]
+    result = ApiResponse(type="success", data={"chats": chats, "has_next": False, "next_cursor": None})
+    validated = response_adapter.validate_python(result.model_dump())
+    return json.dumps(jsonable_encoder(validated), separators=(",", ":")).encode()
+
+
+def trusted_path(documents: List[Dict[str, Any]]) -> bytes:
+    chats = [chat_document(document) for document in documents]
+    result = ApiResponse(type="success", data={"chats": chats, "has_next": False, "next_cursor": None})
+    return TrustedJSONResponse(result).body
+
+
+def measure(fn: Callable[[List[Dict[str, Any]]], bytes], documents: List[Dict[str, Any]], rounds: int) -> float:
+    fn(documents)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn(documents)
+    return (time.perf_counter() - started) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare validated and trusted chat history serialization")
+    parser.add_argument("--messages", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'messages':>8} {'validated ms':>13} {'trusted ms':>11} {'speedup':>8}")
+    for count in args.messages:
+        documents = make_documents(count)
+        assert json.loads(validated_path(documents)) == json.loads(trusted_path(documents))
+        validated = measure(validated_path, documents, args.rounds)
+        trusted = measure(trusted_path, documents, args.rounds)
+        print(f"{count:>8} {validated * 1000:>13.3f} {trusted * 1000:>11.3f} {validated / trusted:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,150 @@
 from fastapi import FastAPI, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from motor.motor_asyncio import AsyncIOMotorClient
 from app.routes.index import router as routes
 from app.middlewares.user_middleware import UserMiddleware
+from app.middlewares.admission_middleware import AdmissionMiddleware
+from app.services.flow_engine import FlowEngine
+from app.services.index_manager import IndexManager
+from app.services.event_hub import BusBackend, EventHub
+from app.services.invalidation import FLOWS_CHANGED, InvalidationBus
+from app.services.compactor import ChatCompactor
+from app.services.idempotency import IdempotencyStore, REPLAYED_HEADER
+from app.services.chatbot_services import ChatbotService
+from app.services.user_services import UserService
+from app.startup import StartupReport
+from app.metrics import REGISTRY, Gauge, MetricsMiddleware, MongoCommandMetrics, MongoPoolMetrics, ObservedCounter
+from app.db_monitor import SlowQueryListener
+from app.tracing import MongoTracingListener, Tracer, TracingMiddleware
+import asyncio
 import os
 from dotenv import load_dotenv
-from typing import AsyncIterator
+from typing import Any, AsyncIterator, Dict
 from bson.codec_options import CodecOptions
 from bson.binary import UuidRepresentation
 
 load_dotenv()
 
+MONGO_POOL_SETTINGS = {
+    "MONGO_MAX_POOL_SIZE": ("maxPoolSize", int),
+    "MONGO_MIN_POOL_SIZE": ("minPoolSize", int),
+    "MONGO_MAX_IDLE_TIME_MS": ("maxIdleTimeMS", int),
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": ("waitQueueTimeoutMS", int),
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": ("serverSelectionTimeoutMS", int),
+    "MONGO_COMPRESSORS": ("compressors", str),
+}
+
+def get_client_options() -> Dict[str, Any]:
+    # Only settings present in the environment are passed, the driver defaults apply otherwise
+    options = {}
+    for env_name, (option, cast) in MONGO_POOL_SETTINGS.items():
+        value = os.getenv(env_name)
+        if value:
+            options[option] = cast(value)
+    return options
+
 async def get_database_client() -> AsyncIOMotorClient:
     mongodb_url = os.getenv("MONGODB_URL")
     if not mongodb_url:
         raise ValueError("MONGODB_URL environment variable is not set")
-    client = AsyncIOMotorClient(mongodb_url)
+    slow_queries = SlowQueryListener()
+    client = AsyncIOMotorClient(
+        mongodb_url,
+        event_listeners=[MongoCommandMetrics(), MongoPoolMetrics(), MongoTracingListener(), slow_queries],
+        **get_client_options()
+    )
+    slow_queries.attach(client)
     return client
 
-async def lifespan(app: FastAPI) -> AsyncIterator[None]:
-    # Startup event
-    app.mongodb_client = await get_database_client()
-    app.mongodb = app.mongodb_client.get_database(
-        "artisan",
+async def warm_up_pool(client: AsyncIOMotorClient):
+    # The first ping pays for server selection, concurrent ones then open the minimum connections
+    await client.admin.command("ping")
+    connections = int(os.getenv("MONGO_MIN_POOL_SIZE") or 0)
+    if connections > 1:
+        await asyncio.gather(*(client.admin.command("ping") for _ in range(connections)))
+
+def get_database(client: AsyncIOMotorClient):
+    return client.get_database(
+        os.getenv("MONGODB_DATABASE", "artisan"),
         codec_options=CodecOptions(uuid_representation=UuidRepresentation.STANDARD)
     )
+
+def register_service_metrics(state: Any):
+    # Counts the services keep themselves are read from app.state when /metrics is scraped
+    user_cache = state.user_service.cache
+    REGISTRY.register(ObservedCounter("user_cache_hits_total", "User lookups answered from the cache.", lambda: user_cache.hits))
+    REGISTRY.register(ObservedCounter("user_cache_misses_total", "User lookups that went to MongoDB.", lambda: user_cache.misses))
+    REGISTRY.register(ObservedCounter("user_cache_evictions_total", "Users evicted from the cache to stay within its size.", lambda: user_cache.evictions))
+    REGISTRY.register(Gauge("user_cache_entries", "Users held in the cache.", lambda: user_cache.stats()["size"]))
+    REGISTRY.register(ObservedCounter("idempotent_replays_total", "Responses replayed for a repeated Idempotency-Key.", lambda: state.idempotency_store.replays))
+    REGISTRY.register(ObservedCounter("chat_events_dropped_total", "Chat events dropped for subscribers that fell behind.", lambda: state.event_hub.dropped))
+    REGISTRY.register(ObservedCounter("chat_lock_table_overflows_total", "Chat writes that ran without an in-process lock because the table was full.", lambda: state.chatbot_service.chat_locks.overflows))
+    REGISTRY.register(ObservedCounter("compacted_messages_total", "Discarded chat messages deleted by the compactor.", lambda: state.compactor.removed))
+
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # Startup event
+    state = app.state
+    state.startup = startup = StartupReport()
+    try:
+        state.tracer = Tracer()
+        state.tracer.start()
+        state.flow_engine = FlowEngine()
+        state.mongodb_client = await get_database_client()
+        # The flow definitions compile in a thread while Mongo connects
+        await asyncio.gather(
+            startup.run("load_flows", asyncio.to_thread(state.flow_engine.load)),
+            startup.run("connect_mongo", warm_up_pool(state.mongodb_client))
+        )
+        state.flow_engine.start_watching()
+        state.mongodb = get_database(state.mongodb_client)
+        index_manager = IndexManager(state.mongodb)
+        await startup.run("ensure_indexes", index_manager.ensure_indexes())
+        for collection_name, error in index_manager.failed.items():
+            startup.warn(f"Indexes on {collection_name} were not created: {error}")
+        if os.getenv("MONGO_INDEX_CHECK", "").lower() in ("1", "true", "yes"):
+            await startup.run("check_query_plans", index_manager.check_query_plans())
+        state.invalidation_bus = bus = InvalidationBus(state.mongodb)
+        bus.subscribe(FLOWS_CHANGED, lambda payload: state.flow_engine.request_reload())
+        state.flow_engine.on_reload = lambda: bus.publish(FLOWS_CHANGED, {"mtime_ns": state.flow_engine.flows.mtime_ns})
+        state.chatbot_service = ChatbotService(state.mongodb, state.flow_engine)
+        state.user_service = UserService(state.mongodb, bus=bus)
+        state.idempotency_store = IdempotencyStore(state.mongodb)
+        # With several workers an SSE subscriber may be connected to another process than the publisher
+        state.event_hub = EventHub(BusBackend(bus) if bus.distributed else None)
+        await startup.run("event_hub", state.event_hub.start())
+        await startup.run("invalidation_bus", bus.start())
+        state.compactor = ChatCompactor(state.mongodb)
+        state.compactor.start()
+        register_service_metrics(state)
+    except Exception as e:
+        startup.mark_failed(e)
+        raise
+    startup.mark_ready()
     yield  # Application is now running
     # Shutdown event
-    app.mongodb_client.close()
+    startup.mark_draining()
+    await state.compactor.stop()
+    await state.invalidation_bus.stop()
+    await state.event_hub.stop()
+    await state.flow_engine.stop_watching()
+    state.mongodb_client.close()
+    state.tracer.stop()
 
 app = FastAPI(lifespan=lifespan)
 
-# Add CORS middleware
+# Add custom UserMiddleware
+app.add_middleware(UserMiddleware)
+
+app.add_middleware(TracingMiddleware)
+
+# Turns requests away before they resolve an identity or touch MongoDB
+app.add_middleware(AdmissionMiddleware)
+
+# Wraps admission, so the timings include identity resolution and rejections are counted
+app.add_middleware(MetricsMiddleware)
+
+# Add CORS middleware, outermost so 429 and 503 responses from admission carry CORS headers too
 origins = ["*"]
 
 app.add_middleware(
@@ -40,13 +153,27 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", REPLAYED_HEADER, "Retry-After"],
 )
 
-# Add custom UserMiddleware
-app.add_middleware(UserMiddleware)
-
 @app.get('/')
 def read_root():
     return {'Ping': 'Pong'}
 
+@app.get('/healthz')
+async def liveness():
+    return {'status': 'ok'}
+
+@app.get('/metrics')
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get('/readyz')
+async def readiness(request: Request):
+    # Ready only once every startup phase has finished, and no longer once shutdown begins
+    startup = getattr(request.app.state, "startup", None)
+    if startup is None:
+        return JSONResponse(status_code=503, content={'status': 'starting'})
+    return JSONResponse(status_code=200 if startup.ready else 503, content=startup.as_dict())
+
 app.include_router(routes, prefix="/api/v1")
\ No newline at end of file
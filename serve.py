@@ -0,0 +1,31 @@
+import argparse
+import os
+
+import uvicorn
+from dotenv import load_dotenv
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Run the API with one or more worker processes")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    # Containers often report the host's CPUs rather than their own share, and every worker opens
+    # its own MongoDB pool and background tasks, so the count is never guessed from the CPUs
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("WEB_CONCURRENCY") or 1),
+        help="worker processes, defaults to WEB_CONCURRENCY or 1"
+    )
+    args = parser.parse_args()
+
+    # Workers share nothing in memory, so caches and SSE events have to travel through MongoDB
+    if args.workers > 1 and not os.getenv("INVALIDATION_BUS"):
+        os.environ["INVALIDATION_BUS"] = "auto"
+
+    uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers, proxy_headers=True)
+
+
+if __name__ == "__main__":
+    main()
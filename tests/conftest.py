@@ -0,0 +1,123 @@
+import functools
+import os
+import uuid
+from datetime import datetime, timezone
+
+os.environ.setdefault("MONGODB_URL", "mongodb://tests")
+os.environ["RATE_LIMIT_PER_SECOND"] = "0"
+os.environ["INVALIDATION_BUS"] = "off"
+
+import bson
+import httpx
+import mongomock.collection
+import mongomock_motor
+import pytest
+from bson.binary import UuidRepresentation
+from bson.codec_options import CodecOptions
+
+import main
+from app.controllers.chatbot_controllers import CHATBOT_USER_ID
+from app.db_monitor import current_stats
+
+# mongomock checks documents with bson's default codec, which refuses the UUIDs the app stores
+STANDARD_UUIDS = CodecOptions(uuid_representation=UuidRepresentation.STANDARD)
+
+
+class _StandardUuidBSON:
+    @staticmethod
+    def encode(document, check_keys=False):
+        return bson.encode(document, check_keys, STANDARD_UUIDS)
+
+
+mongomock.collection.BSON = _StandardUuidBSON
+
+# mongomock issues no commands, so pymongo's command listeners never see them. Every collection
+# call and the first fetch of a cursor are counted as one round trip instead, through the same
+# stats that SlowQueryListener feeds in production.
+COMMAND_METHODS = (
+    "count_documents", "delete_many", "delete_one", "find_one", "find_one_and_update",
+    "insert_many", "insert_one", "update_many", "update_one",
+)
+CURSOR_METHODS = ("next", "__anext__", "to_list")
+
+
+def _record():
+    stats = current_stats()
+    if stats is not None:
+        stats.record()
+
+
+def _counted_command(method):
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        _record()
+        return await method(self, *args, **kwargs)
+    return wrapper
+
+
+def _counted_fetch(method):
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        if not self.__dict__.get("_fetched"):
+            self.__dict__["_fetched"] = True
+            _record()
+        return await method(self, *args, **kwargs)
+    return wrapper
+
+
+class FakeClient(mongomock_motor.AsyncMongoMockClient):
+    def get_database(self, *args, **kwargs):
+        kwargs.pop("codec_options", None)
+        return super().get_database(*args, **kwargs)
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(autouse=True)
+def counted_round_trips(monkeypatch):
+    for name in COMMAND_METHODS:
+        monkeypatch.setattr(mongomock_motor.AsyncMongoMockCollection, name, _counted_command(getattr(mongomock_motor.AsyncMongoMockCollection, name)))
+    for cursor_class in (mongomock_motor.AsyncCursor, mongomock_motor.AsyncLatentCommandCursor):
+        for name in CURSOR_METHODS:
+            monkeypatch.setattr(cursor_class, name, _counted_fetch(getattr(cursor_class, name)))
+
+
+@pytest.fixture
+async def app(monkeypatch):
+    async def fake_client():
+        return FakeClient()
+    monkeypatch.setattr(main, "get_database_client", fake_client)
+    async with main.app.router.lifespan_context(main.app):
+        yield main.app
+
+
+@pytest.fixture
+async def user_id(app):
+    user_id = uuid.uuid4()
+    now = datetime.now(timezone.utc)
+    users = app.state.mongodb["users"]
+    await users.insert_many([
+        {"user_id": user_id, "name": "user", "profile_image": "", "is_bot": False, "created_at": now, "updated_at": now},
+        {"user_id": uuid.UUID(CHATBOT_USER_ID), "name": "bot", "profile_image": "", "is_bot": True, "created_at": now, "updated_at": now},
+    ])
+    return str(user_id)
+
+
+@pytest.fixture
+async def client(app, user_id):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", headers={"User-ID": user_id}) as client:
+        yield client
+
+
+@pytest.fixture
+async def chat_id(client):
+    # A chat that has seen its first bot turn, with the caller and the bot already in the user cache
+    response = await client.post("/api/v1/chatbot/create_chat")
+    chat_id = response.json()["data"]["chat_id"]
+    await client.post(f"/api/v1/chatbot/{chat_id}/get_response", json={"context": "ONBOARDING"})
+    await client.get("/api/v1/chatbot/")
+    return chat_id
@@ -0,0 +1,25 @@
+import pytest
+
+from app.metrics import REGISTRY
+
+pytestmark = pytest.mark.anyio
+
+BASE = "/api/v1/chatbot"
+ONBOARDING = {"context": "ONBOARDING"}
+GENERATE_REPORT = {"type": "string", "value": "Generate report", "action_id": "action_step_1_1"}
+
+
+async def test_pushed_bot_turn_does_not_hold_a_slot(app, client, chat_id, monkeypatch):
+    in_flight = REGISTRY._metrics["http_requests_in_flight"].read
+    seen = []
+    publish = app.state.event_hub.publish
+
+    async def observe(chat_id, event):
+        seen.append(in_flight())
+        await publish(chat_id, event)
+
+    monkeypatch.setattr(app.state.event_hub, "publish", observe)
+    response = await client.post(f"{BASE}/{chat_id}/add_chat", json={**ONBOARDING, "message": GENERATE_REPORT, "push": True})
+    assert response.json()["type"] == "success"
+    assert seen == [0]
+    assert in_flight() == 0
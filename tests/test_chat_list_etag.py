@@ -0,0 +1,44 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import app.services.chatbot_services as chatbot_services
+
+pytestmark = pytest.mark.anyio
+
+BASE = "/api/v1/chatbot"
+ONBOARDING = {"context": "ONBOARDING"}
+FROZEN = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+class FrozenDatetime(datetime):
+    # Every write lands in the same millisecond, or on a writer whose clock lags behind
+    @classmethod
+    def now(cls, tz=None):
+        return FROZEN
+
+
+async def list_etag(client):
+    response = await client.get(f"{BASE}/")
+    assert response.json()["type"] == "success"
+    return response.headers["etag"]
+
+
+async def test_list_tag_moves_with_every_summary_write(client, chat_id, monkeypatch):
+    monkeypatch.setattr(chatbot_services, "datetime", FrozenDatetime)
+    hello = {**ONBOARDING, "message": {"type": "string", "value": "hello"}}
+    await client.post(f"{BASE}/{chat_id}/add_chat", json=hello)
+    etag = await list_etag(client)
+
+    # The same chat stays on top with the same updated_at, its last message and count still change
+    await client.post(f"{BASE}/{chat_id}/add_chat", json=hello)
+    response = await client.get(f"{BASE}/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+    # A second chat written at the same wall-clock time still changes the list
+    etag = response.headers["etag"]
+    await client.post(f"{BASE}/create_chat")
+    response = await client.get(f"{BASE}/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(response.json()["data"]) == 2
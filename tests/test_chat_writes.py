@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from app.controllers.chatbot_controllers import CHATBOT_USER_ID
+from app.metrics import CHAT_WRITE_CONFLICTS
+from app.schemas import ApiResponse
+from app.services.chatbot_services import ChatbotService, ChatStateConflict
+
+pytestmark = pytest.mark.anyio
+
+BASE = "/api/v1/chatbot"
+ONBOARDING = {"context": "ONBOARDING"}
+GENERATE_REPORT = {"type": "string", "value": "Generate report", "action_id": "action_step_1_1"}
+
+
+def worker(app) -> ChatbotService:
+    # Each service has its own lock table, like a separate worker process
+    return ChatbotService(app.state.mongodb, app.state.flow_engine)
+
+
+async def message_count(app, chat_id) -> int:
+    return await app.state.mongodb["chatbot_messages"].count_documents({"chat_id": chat_id})
+
+
+async def test_stale_version_is_rejected(app, chat_id):
+    service = worker(app)
+    version = (await service.get_chat_state(chat_id))["version"]
+
+    with pytest.raises(ChatStateConflict):
+        await service.allocate_seq(chat_id, 1, expected_version=version - 1)
+    with pytest.raises(ChatStateConflict):
+        await service.commit_chat_state(chat_id, {"ONBOARDING": "STEP_2"}, version - 1)
+
+    state = await service.get_chat_state(chat_id)
+    assert (state["version"], state["pending"], state["ONBOARDING"]) == (version, 0, "STEP_1")
+
+
+async def test_retry_reads_the_state_again(app, chat_id):
+    states = []
+
+    async def attempt(state):
+        states.append(state)
+        if len(states) == 1:
+            raise ChatStateConflict(chat_id)
+        return ApiResponse(type="success")
+
+    retried = CHAT_WRITE_CONFLICTS.value("retried")
+    result = await worker(app).write_chat(chat_id, attempt, {"version": 0})
+    assert result.type == "success"
+    assert states == [{"version": 0}, None]
+    assert CHAT_WRITE_CONFLICTS.value("retried") == retried + 1
+
+
+async def test_exhausted_retries_ask_the_client_to_retry(app, chat_id, monkeypatch):
+    monkeypatch.setenv("CHAT_WRITE_RETRIES", "2")
+    service = worker(app)
+    attempts = 0
+
+    async def attempt(state):
+        nonlocal attempts
+        attempts += 1
+        raise ChatStateConflict(chat_id)
+
+    rejected = CHAT_WRITE_CONFLICTS.value("rejected")
+    result = await service.write_chat(chat_id, attempt)
+    assert result.type == "error"
+    assert result.message == "Chat was changed by another request, please retry"
+    assert attempts == 3
+    assert CHAT_WRITE_CONFLICTS.value("rejected") == rejected + 1
+
+
+async def test_two_workers_answer_a_turn_once(app, client, user_id, chat_id):
+    await client.post(f"{BASE}/{chat_id}/add_chat", json={**ONBOARDING, "message": GENERATE_REPORT})
+    before = await message_count(app, chat_id)
+    state = await app.state.chatbot_service.get_chat_state(chat_id)
+
+    # Both read the same state; the second one's version check fails and its retry sees the answer
+    results = await asyncio.gather(*(
+        worker(app).get_chatbot_response(chat_id, "ONBOARDING", CHATBOT_USER_ID, user_id, dict(state))
+        for _ in range(2)
+    ))
+    assert sorted(len(result.data["chats"]) for result in results) == [0, 2]
+    assert await message_count(app, chat_id) == before + 2
+
+
+async def test_delete_racing_an_action_keeps_the_state_consistent(app, client, user_id, chat_id):
+    response = await client.post(f"{BASE}/{chat_id}/add_chat", json={**ONBOARDING, "message": {"type": "string", "value": "hi"}})
+    hi = response.json()["data"]["message"]["id"]
+    stale = await app.state.chatbot_service.get_chat_state(chat_id)
+
+    # The action lands first, the delete then commits against the state it read before
+    await client.post(f"{BASE}/{chat_id}/add_chat", json={**ONBOARDING, "message": GENERATE_REPORT})
+    with pytest.raises(ChatStateConflict):
+        await worker(app).commit_chat_state(chat_id, {"last_from_bot": True}, stale["version"])
+
+    result = await worker(app).delete_chat_message(chat_id, hi, "ONBOARDING", user_id)
+    assert result.type == "success"
+    state = await app.state.chatbot_service.get_chat_state(chat_id)
+    assert state["last_from_bot"] is True
+    assert state["pending"] == 0
@@ -0,0 +1,40 @@
+import pytest
+
+from app.db_monitor import DbCallBudgetExceeded, db_call_budget
+
+pytestmark = pytest.mark.anyio
+
+BASE = "/api/v1/chatbot"
+ONBOARDING = {"context": "ONBOARDING"}
+GENERATE_REPORT = {"type": "string", "value": "Generate report", "action_id": "action_step_1_1"}
+
+
+async def test_get_response_budget(client, chat_id):
+    await client.post(f"{BASE}/{chat_id}/add_chat", json={**ONBOARDING, "message": GENERATE_REPORT})
+    with db_call_budget(6):
+        response = await client.post(f"{BASE}/{chat_id}/get_response", json=ONBOARDING)
+    assert response.json()["type"] == "success"
+
+
+async def test_add_chat_budget(client, chat_id):
+    with db_call_budget(6):
+        response = await client.post(f"{BASE}/{chat_id}/add_chat", json={**ONBOARDING, "message": GENERATE_REPORT})
+    assert response.json()["type"] == "success"
+
+
+async def test_history_budget(client, chat_id):
+    with db_call_budget(2):
+        response = await client.post(f"{BASE}/{chat_id}", json=ONBOARDING)
+    assert response.json()["type"] == "success"
+
+
+async def test_chat_list_budget(client, chat_id):
+    with db_call_budget(2):
+        response = await client.get(f"{BASE}/")
+    assert response.json()["type"] == "success"
+
+
+async def test_budget_fails_when_exceeded(client, chat_id):
+    with pytest.raises(DbCallBudgetExceeded, match="2 database calls, budget is 1"):
+        with db_call_budget(1):
+            await client.post(f"{BASE}/{chat_id}", json=ONBOARDING)
@@ -0,0 +1,85 @@
+import uuid
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+BASE = "/api/v1/chatbot"
+ONBOARDING = {"context": "ONBOARDING"}
+INVALID_ID = "not-a-uuid"
+
+# With several things wrong, the error reported is the first of: authentication, chat not found,
+# chat ended, invalid message id, message not found
+
+
+async def delete(client, chat_id, message_id, headers=None):
+    return await client.request(
+        "DELETE", f"{BASE}/{chat_id}/delete_chat_message", json={**ONBOARDING, "message_id": message_id}, headers=headers
+    )
+
+
+async def update(client, chat_id, message_id, headers=None):
+    return await client.put(
+        f"{BASE}/{chat_id}/update_chat_message",
+        json={**ONBOARDING, "message_id": message_id, "message": {"type": "string", "value": "edited"}},
+        headers=headers
+    )
+
+
+async def add_from(client, chat_id, message_id, headers=None):
+    return await client.post(
+        f"{BASE}/{chat_id}/add_chat",
+        json={**ONBOARDING, "message": {"type": "string", "value": "again"}, "from_message_id": message_id},
+        headers=headers
+    )
+
+
+ENDPOINTS = {
+    "delete": (delete, "Cannot delete message after chat has ended", "badly formed hexadecimal UUID string", "Message not found"),
+    "update": (update, "Cannot update message after chat has ended", "Invalid message_id format", "Message not found"),
+    "add_chat": (add_from, "Cannot add message after chat has ended", "badly formed hexadecimal UUID string", "From message not found"),
+}
+
+
+@pytest.fixture
+async def ended_chat_id(client, chat_id):
+    for action in ({"value": "Generate report", "action_id": "action_step_1_1"}, {"value": "No", "action_id": "action_step_2_2"}):
+        await client.post(f"{BASE}/{chat_id}/add_chat", json={**ONBOARDING, "message": {"type": "string", **action}})
+        await client.post(f"{BASE}/{chat_id}/get_response", json=ONBOARDING)
+    response = await client.post(f"{BASE}/{chat_id}", json=ONBOARDING)
+    assert response.json()["data"]["has_next"] is False
+    return chat_id
+
+
+def error(response):
+    body = response.json()
+    assert body["type"] == "error"
+    return body["message"]
+
+
+@pytest.mark.parametrize("endpoint", ENDPOINTS)
+async def test_authentication_comes_first(client, endpoint):
+    send = ENDPOINTS[endpoint][0]
+    unknown_user = {"User-ID": str(uuid.uuid4())}
+    assert error(await send(client, "missing", INVALID_ID, unknown_user)) == "User not found"
+    assert error(await send(client, "missing", INVALID_ID, {"User-ID": "nope"})) == "Invalid User-ID"
+
+
+@pytest.mark.parametrize("endpoint", ENDPOINTS)
+async def test_missing_chat_comes_before_the_message_id(client, endpoint):
+    send = ENDPOINTS[endpoint][0]
+    assert error(await send(client, "missing", INVALID_ID)) == "Chat not found"
+
+
+@pytest.mark.parametrize("endpoint", ENDPOINTS)
+async def test_ended_chat_comes_before_the_message_id(client, ended_chat_id, endpoint):
+    send, ended, _, _ = ENDPOINTS[endpoint]
+    assert error(await send(client, ended_chat_id, INVALID_ID)) == ended
+    assert error(await send(client, ended_chat_id, str(uuid.uuid4()))) == ended
+
+
+@pytest.mark.parametrize("endpoint", ENDPOINTS)
+async def test_invalid_id_comes_before_a_missing_message(client, chat_id, endpoint):
+    send, _, invalid, not_found = ENDPOINTS[endpoint]
+    assert error(await send(client, chat_id, INVALID_ID)) == invalid
+    assert error(await send(client, chat_id, str(uuid.uuid4()))) == not_found
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from app.models.chatbot_models import MessageInfo
+from app.services.chatbot_services import ChatbotService
+
+pytestmark = pytest.mark.anyio
+
+BASE = "/api/v1/chatbot"
+ONBOARDING = {"context": "ONBOARDING"}
+
+
+class HeldInserts:
+    # Holds insert_many until released, like a writer in another worker whose messages are still in flight
+    def __init__(self, collection, fail: bool = False):
+        self.collection = collection
+        self.fail = fail
+        self.reached = asyncio.Event()
+        self.release = asyncio.Event()
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    async def insert_many(self, *args, **kwargs):
+        self.reached.set()
+        await self.release.wait()
+        if self.fail:
+            raise RuntimeError("insert failed")
+        return await self.collection.insert_many(*args, **kwargs)
+
+
+def worker(app, inserts=None) -> ChatbotService:
+    service = ChatbotService(app.state.mongodb, app.state.flow_engine)
+    if inserts is not None:
+        inserts.collection = service.chatbot_messages
+        service.chatbot_messages = inserts
+    return service
+
+
+def hello(value: str = "hello") -> MessageInfo:
+    return MessageInfo(type="string", value=value)
+
+
+async def history_etag(client, chat_id):
+    response = await client.post(f"{BASE}/{chat_id}", json=ONBOARDING)
+    assert response.json()["type"] == "success"
+    return response.headers.get("etag")
+
+
+async def test_history_is_untagged_while_an_overtaken_write_lands(app, client, user_id, chat_id):
+    held = HeldInserts(None)
+    slow = asyncio.create_task(worker(app, held).add_chat_message(chat_id, hello("slow"), user_id, "ONBOARDING"))
+    await held.reached.wait()
+
+    # A second worker commits after the slow one and finishes first
+    fast = await worker(app).add_chat_message(chat_id, hello("fast"), user_id, "ONBOARDING")
+    assert fast.type == "success"
+    assert await history_etag(client, chat_id) is None
+
+    held.release.set()
+    assert (await slow).type == "success"
+    etag = await history_etag(client, chat_id)
+    assert etag is not None
+
+    # Tagging keeps working for later writes
+    for value in ("one", "two", "three"):
+        await worker(app).add_chat_message(chat_id, hello(value), user_id, "ONBOARDING")
+        assert await history_etag(client, chat_id) not in (None, etag)
+    etag = await history_etag(client, chat_id)
+    response = await client.post(f"{BASE}/{chat_id}", json=ONBOARDING, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+async def test_a_failed_write_does_not_stop_tagging(app, client, user_id, chat_id):
+    held = HeldInserts(None, fail=True)
+    held.release.set()
+    result = await worker(app, held).add_chat_message(chat_id, hello(), user_id, "ONBOARDING")
+    assert result.type == "error"
+
+    state = await app.state.chatbot_service.get_chat_state(chat_id)
+    assert state["pending"] == 0
+    assert await history_etag(client, chat_id) is not None
@@ -0,0 +1,35 @@
+import pytest
+
+from app.metrics import HTTP_DB_CALLS, HTTP_LATENCY, HTTP_REQUESTS
+
+pytestmark = pytest.mark.anyio
+
+BASE = "/api/v1/chatbot"
+ROUTE = "/api/v1/chatbot/{chat_id}"
+ONBOARDING = {"context": "ONBOARDING"}
+GENERATE_REPORT = {"type": "string", "value": "Generate report", "action_id": "action_step_1_1"}
+
+
+async def test_pushed_bot_turn_is_not_counted_in_the_request(app, client, chat_id):
+    labels = ("POST", f"{ROUTE}/add_chat")
+    calls, count = HTTP_DB_CALLS.sum(*labels), HTTP_DB_CALLS.count(*labels)
+    messages = app.state.mongodb["chatbot_messages"]
+    before = await messages.count_documents({"chat_id": chat_id})
+
+    response = await client.post(f"{BASE}/{chat_id}/add_chat", json={**ONBOARDING, "message": GENERATE_REPORT, "push": True})
+    assert response.json()["type"] == "success"
+
+    # The bot turn ran after the response, its writes belong to no request
+    assert await messages.count_documents({"chat_id": chat_id}) > before + 1
+    assert HTTP_DB_CALLS.count(*labels) == count + 1
+    assert HTTP_DB_CALLS.sum(*labels) - calls == 6
+
+
+async def test_event_streams_are_counted_but_not_timed(client, chat_id):
+    labels = ("GET", f"{ROUTE}/events")
+    requests, timed = HTTP_REQUESTS.value(*labels, "200"), HTTP_LATENCY.count(*labels)
+
+    response = await client.get(f"{BASE}/missing/events")
+    assert response.json()["message"] == "Chat not found"
+    assert HTTP_REQUESTS.value(*labels, "200") == requests + 1
+    assert HTTP_LATENCY.count(*labels) == timed
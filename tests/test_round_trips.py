@@ -0,0 +1,112 @@
+import pytest
+
+from app.db_monitor import track_db_calls
+
+pytestmark = pytest.mark.anyio
+
+BASE = "/api/v1/chatbot"
+ONBOARDING = {"context": "ONBOARDING"}
+GENERATE_REPORT = {"type": "string", "value": "Generate report", "action_id": "action_step_1_1"}
+HELLO = {"type": "string", "value": "hello"}
+
+# Commands per request with a warm user cache. A change here is a change in latency,
+# make it on purpose.
+
+
+async def round_trips(request):
+    with track_db_calls() as stats:
+        response = await request
+    return stats.calls, response
+
+
+async def add(client, chat_id, message):
+    response = await client.post(f"{BASE}/{chat_id}/add_chat", json={**ONBOARDING, "message": message})
+    return response.json()["data"]
+
+
+async def test_create_chat(client):
+    # Seq block, summary and message insert, inbox version, release, then the created document is read back
+    calls, response = await round_trips(client.post(f"{BASE}/create_chat"))
+    assert response.json()["type"] == "success"
+    assert calls == 6
+
+
+async def test_get_response_with_nothing_to_answer(client, chat_id):
+    calls, response = await round_trips(client.post(f"{BASE}/{chat_id}/get_response", json=ONBOARDING))
+    assert response.json()["data"]["chats"] == []
+    assert calls == 1
+
+
+async def test_get_response_runs_a_transition(client, chat_id):
+    await add(client, chat_id, GENERATE_REPORT)
+    calls, response = await round_trips(client.post(f"{BASE}/{chat_id}/get_response", json=ONBOARDING))
+    assert len(response.json()["data"]["chats"]) == 2
+    assert calls == 6
+
+
+async def test_add_chat(client, chat_id):
+    calls, response = await round_trips(client.post(f"{BASE}/{chat_id}/add_chat", json={**ONBOARDING, "message": HELLO}))
+    assert response.json()["type"] == "success"
+    assert calls == 6
+
+
+async def test_add_chat_with_idempotency_key(client, chat_id):
+    request = {"json": {**ONBOARDING, "message": HELLO}, "headers": {"Idempotency-Key": "retry-1"}}
+    calls, first = await round_trips(client.post(f"{BASE}/{chat_id}/add_chat", **request))
+    # Claiming and storing the key come on top of the write
+    assert calls == 8
+
+    calls, replayed = await round_trips(client.post(f"{BASE}/{chat_id}/add_chat", **request))
+    assert replayed.json() == first.json()
+    assert calls == 0
+
+
+async def test_history(client, chat_id):
+    calls, response = await round_trips(client.post(f"{BASE}/{chat_id}", json=ONBOARDING))
+    assert response.json()["type"] == "success"
+    assert calls == 2
+
+    calls, response = await round_trips(client.post(f"{BASE}/{chat_id}", json=ONBOARDING, headers={"If-None-Match": response.headers["etag"]}))
+    assert response.status_code == 304
+    assert calls == 1
+
+
+async def test_chat_list(client, chat_id):
+    calls, response = await round_trips(client.get(f"{BASE}/"))
+    assert response.json()["type"] == "success"
+    assert calls == 2
+
+    calls, response = await round_trips(client.get(f"{BASE}/", headers={"If-None-Match": response.headers["etag"]}))
+    assert response.status_code == 304
+    assert calls == 1
+
+
+async def test_update_chat_message(client, chat_id):
+    hello = await add(client, chat_id, HELLO)
+    calls, response = await round_trips(client.put(
+        f"{BASE}/{chat_id}/update_chat_message",
+        json={**ONBOARDING, "message_id": hello["message"]["id"], "message": {"type": "string", "value": "edited"}}
+    ))
+    assert response.json()["type"] == "success"
+    assert calls == 7
+
+
+async def test_delete_chat_message(client, chat_id):
+    hello = await add(client, chat_id, HELLO)
+    calls, response = await round_trips(client.request(
+        "DELETE", f"{BASE}/{chat_id}/delete_chat_message", json={**ONBOARDING, "message_id": hello["message"]["id"]}
+    ))
+    assert response.json()["type"] == "success"
+    assert calls == 7
+
+
+async def test_export(client, chat_id):
+    calls, response = await round_trips(client.get(f"{BASE}/{chat_id}/export"))
+    assert response.status_code == 200
+    assert calls == 3
+
+
+async def test_events_for_a_missing_chat(client, chat_id):
+    calls, response = await round_trips(client.get(f"{BASE}/missing/events"))
+    assert response.json()["message"] == "Chat not found"
+    assert calls == 1
@@ -0,0 +1,36 @@
+import pytest
+
+from app.tracing import SpanExporter, Tracer
+
+pytestmark = pytest.mark.anyio
+
+BASE = "/api/v1/chatbot"
+ONBOARDING = {"context": "ONBOARDING"}
+GENERATE_REPORT = {"type": "string", "value": "Generate report", "action_id": "action_step_1_1"}
+
+
+class CapturingExporter(SpanExporter):
+    def __init__(self):
+        super().__init__()
+        self.traces = []
+
+    def export(self, trace):
+        self.traces.append(trace)
+
+    def write(self, batch):
+        pass
+
+
+async def test_root_span_ends_with_the_response(app, client, chat_id, monkeypatch):
+    exporter = CapturingExporter()
+    monkeypatch.setattr(app.state, "tracer", Tracer(exporter, sample_rate=1))
+
+    response = await client.post(f"{BASE}/{chat_id}/add_chat", json={**ONBOARDING, "message": GENERATE_REPORT, "push": True})
+    assert response.json()["type"] == "success"
+
+    (trace,) = exporter.traces
+    root = next(span for span in trace.spans if span.parent_id is None)
+    pushed = next(span for span in trace.spans if span.name == "push_chatbot_response")
+    # The pushed turn stays in the trace, after the response it doesn't delay
+    assert pushed.parent_id == root.span_id
+    assert root.end_ns <= pushed.start_ns